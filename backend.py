@@ -9,21 +9,62 @@ from fastapi import FastAPI
 load_dotenv()
 
 from server import create_app
-from server.core.mqtt import event_sink, monitor_lost, process_kmqtt, process_status
+from server.api.discover import kf as keonn_finder
+from server.api.fleet import fleet_jobs
+from server.core.journal import journal
+from server.core.mqtt import (
+    event_sink,
+    flush_heartbeats,
+    monitor_lost,
+    process_kmqtt,
+    process_status,
+    replay_journal,
+    write_heartbeats,
+)
+from server.core.state import collection_versions
+from server.logging import get_configured_logger
+from server.utils.KEONN_interface import sessions as keonn_sessions
+
+logger = get_configured_logger(__name__, "DEBUG")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    try:
+        await keonn_finder.start()
+    except Exception as e:
+        # e.g. no multicast interface, /discover?ip= still works
+        logger.error(f"mDNS discovery unavailable: {e!r}")
     tasks: list[asyncio.Task] = []
-    tasks.append(asyncio.create_task(process_status()))
-    tasks.append(asyncio.create_task(event_sink()))
-    tasks.append(asyncio.create_task(process_kmqtt()))
-    tasks.append(asyncio.create_task(monitor_lost()))
+    if journal.claim():
+        # device liveness is written by whichever process owns ingest
+        tasks.append(asyncio.create_task(process_status()))
+        tasks.append(asyncio.create_task(event_sink()))
+        tasks.append(asyncio.create_task(process_kmqtt()))
+        tasks.append(asyncio.create_task(monitor_lost()))
+        tasks.append(asyncio.create_task(flush_heartbeats()))
+        tasks.append(asyncio.create_task(replay_journal()))
+    else:
+        collection_versions.tracking = False
+        logger.error(
+            "Another process (mqtt_db.py?) is ingesting, serving the API only"
+            " without response caching or /ws/mqtt events"
+        )
 
     yield
     for task in tasks:
         task.cancel()
     await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        await write_heartbeats()
+    except Exception as e:
+        logger.error(f"Final heartbeat flush failed: {e!r}")
+    try:
+        await keonn_finder.async_close()
+    except Exception as e:
+        logger.error(f"Closing mDNS discovery failed: {e!r}")
+    await fleet_jobs.aclose()
+    await keonn_sessions.aclose()
 
 
 app = create_app(lifespan=lifespan)
@@ -19,7 +19,16 @@ from server.models import (
     TagStatus,
     MQTT_Message,
 )
-from server.core.mqtt import monitor_lost, process_kmqtt, event_sink
+from server.core.journal import journal
+from server.core.mqtt import (
+    event_sink,
+    flush_heartbeats,
+    monitor_lost,
+    process_kmqtt,
+    process_status,
+    replay_journal,
+    write_heartbeats,
+)
 
 load_dotenv()
 
@@ -43,11 +52,19 @@ async def main():
         modules={"models": ["server.models"]},
     )
     await Tortoise.generate_schemas(safe=True)
-    await asyncio.gather(
-        monitor_lost(),
-        process_kmqtt(),
-        event_sink(),
-    )
+    if not journal.claim():
+        sys.exit("Another process is already ingesting events")
+    try:
+        await asyncio.gather(
+            monitor_lost(),
+            process_kmqtt(),
+            process_status(),
+            event_sink(),
+            flush_heartbeats(),
+            replay_journal(),
+        )
+    finally:
+        await write_heartbeats()
 
 
 if __name__ == "__main__":
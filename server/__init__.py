@@ -1,4 +1,5 @@
 import os
+from datetime import datetime, timezone
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
@@ -6,7 +7,7 @@ from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 from tortoise.contrib.fastapi import register_tortoise
 
-from server.models import EventType, MQTT_Message
+from server.models import EventType, LiveEvent
 from server.api import api_v1, api_v2
 from server.utils.proxy_fastapi import router as proxy_router
 from server.websockets import router as ws_router
@@ -22,6 +23,7 @@ def create_app(**app_kwargs) -> FastAPI:
                 CORSMiddleware,
                 allow_origins=["http://172.26.224.13"],
                 allow_methods=["*"],
+                expose_headers=["X-Next-Cursor", "ETag"],
             )
         ],
         **app_kwargs,
@@ -42,14 +44,15 @@ def create_app(**app_kwargs) -> FastAPI:
     app.include_router(ws_router, prefix="/ws")
     app.include_router(proxy_router)
 
-    @app.get("/mqtt/schema", response_model=MQTT_Message, tags=["Utilities"])
+    @app.get("/mqtt/schema", response_model=LiveEvent, tags=["Utilities"])
     async def get_mqtt():
-        return MQTT_Message(
-            action=EventType.TAG_LOST,
-            loc_id=1,
-            past_loc_id=1,
-            event_id=1,
+        return LiveEvent(
+            id=1,
+            type=EventType.TAG_LOC_CHANGE,
             tag_id=1,
+            epc="e28011700000020f7cbd7358",
+            data={"from": "60:e8:5b:0a:78:5f/1/0/0", "to": "60:e8:5b:0a:78:5f/2/0/0"},
+            created_at=datetime.now(timezone.utc),
         )
 
     register_tortoise(
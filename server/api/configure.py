@@ -2,9 +2,16 @@ from fastapi import APIRouter
 from fastapi.exceptions import HTTPException
 from fastapi.params import Param
 from tortoise.contrib.pydantic import pydantic_model_creator
+from tortoise.transactions import in_transaction
 
+from server.core.state import (
+    collection_versions,
+    location_index,
+    tag_index,
+    tag_versions,
+)
 from server.logging import get_configured_logger
-from server.models import Device, Location
+from server.models import Device, Location, Tag
 from server.utils.KEONN_interface import (
     API,
     Hz,
@@ -81,8 +88,14 @@ pydantic_Locations = pydantic_model_creator(
     description="Fetch the antenna configuration of the device and update the locations in the database",
 )
 async def get_device_locations(device_id: int) -> list[pydantic_Locations]:  # type: ignore
-    logger.debug(f"Syncing locations for device {device_id}")
     ip = await _get_ip(device_id)
+    await sync_locations(device_id, ip)
+    return await pydantic_Locations.from_queryset(Location.filter(device_id=device_id))
+
+
+async def sync_locations(device_id: int, ip: str) -> dict[str, list[str]]:
+    """Make the device's locations in the DB match its antennas."""
+    logger.debug(f"Syncing locations for device {device_id}")
     locs = {loc: name for loc, name in (await get_locations(API(ip)))}
     logger.debug(f"Locations at {ip}: {locs}")
     dev_locs = set(
@@ -93,11 +106,23 @@ async def get_device_locations(device_id: int) -> list[pydantic_Locations]:  # t
     to_del = dev_locs - set(locs.keys())
     if to_del:
         logger.debug(f"Deleting {to_del=}")
-        await Location.filter(loc__in=to_del).delete()
-
-    for loc in set(locs.keys()) - dev_locs:
+        # keep the tags seen there, the index (only loaded by the ingest
+        # process) has to agree with the DB
+        async with tag_index.lock:
+            if tag_index.loaded:
+                tag_index.clear_locations(to_del)
+            async with in_transaction():
+                await Tag.filter(last_loc_seen_id__in=to_del).update(
+                    last_loc_seen_id=None, version=await tag_versions.next()
+                )
+                await Location.filter(loc__in=to_del).delete()
+
+    to_add = set(locs.keys()) - dev_locs
+    for loc in to_add:
         name = locs[loc]
         await Location.create(loc=loc, name=name, device_id=device_id)
         logger.debug(f"Added {loc=}, {name=!r} to the database")
-
-    return await pydantic_Locations.from_queryset(Location.filter(device_id=device_id))
+    if to_del or to_add:
+        location_index.invalidate()
+        collection_versions.bump("locations", "tags")
+    return {"added": sorted(to_add), "deleted": sorted(to_del)}
@@ -1,8 +1,9 @@
 from fastapi import APIRouter
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field, PositiveFloat
 from tortoise.contrib.pydantic import pydantic_model_creator
 
 from server.api._base import add_get_all, add_get_one, add_patch
+from server.core.state import collection_versions, location_index
 from server.models import Device
 
 router = APIRouter(prefix="/devices", tags=["Devices"])
@@ -19,11 +20,29 @@ pydantic_batch_Device = pydantic_model_creator(
 
 
 class pydantic_Update_Device(BaseModel):
-    name: str | None = None
-    ip: str | None = None
+    name: str = Field(None)
+    ip: str = Field(None)
+    lost_threshold: PositiveFloat | None = None
     model_config = ConfigDict(title="UpdateDevice")
 
 
-add_get_all(router, pydantic_batch_Device, Device.all)
+def on_device_change():
+    location_index.invalidate()
+    collection_versions.bump("devices")
+
+
+add_get_all(
+    router,
+    pydantic_batch_Device,
+    Device.all,
+    filters={"online": (bool, "online"), "device": (int, "id__in")},
+    collection="devices",
+)
 add_get_one(router, pydantic_Device, int, Device.get)
-add_patch(router, pydantic_Device, pydantic_Update_Device, Device)
+add_patch(
+    router,
+    pydantic_Device,
+    pydantic_Update_Device,
+    Device,
+    on_change=on_device_change,
+)
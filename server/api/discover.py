@@ -1,15 +1,33 @@
+import asyncio
+
 import httpx
 from fastapi.params import Param
 
 from server.api._base import forward_exception
 from server.api.device import Device, pydantic_batch_Device
+from server.core.state import collection_versions
 from server.logging import get_configured_logger
 from server.utils.KEONN_interface import API, get_info, get_metadata, make_sound
-from server.utils.detect import KeonnFinder
+from server.utils.detect import MAC, DeviceInfo, KeonnFinder
+from server.utils.proxy_fastapi import update_ip
 
 logger = get_configured_logger(__name__, "DEBUG")
 
-kf = KeonnFinder()
+
+async def on_reader_change(mac: MAC, info: DeviceInfo) -> None:
+    """Follow a known reader to its new address."""
+    dev = await Device.get_or_none(mac=mac)
+    if dev is None or dev.ip == info["ip"]:
+        return
+    logger.info(f"Device {dev.id} moved from {dev.ip} to {info['ip']}")
+    dev.ip = info["ip"]
+    await dev.save(update_fields=["ip"])
+    await update_ip(dev.id, dev.ip)
+    collection_versions.bump("devices")
+
+
+# started by the app lifespan
+kf = KeonnFinder(on_change=on_reader_change)
 
 
 async def discover_devices(ip: str | None = Param(None)) -> list[pydantic_batch_Device]:  # type: ignore
@@ -32,11 +50,14 @@ async def discover_devices(ip: str | None = Param(None)) -> list[pydantic_batch_
             )
             if not added:
                 raise ValueError(f"Device {dev.name} already exists at this address!")
+            collection_versions.bump("devices")
             logger.info(f"{dev.name} added!")
             return [await pydantic_batch_Device.from_tortoise_orm(dev)]
 
         # look for new devices
-        await kf.run_detection()
+        if not kf.running:
+            await kf.start()
+            await asyncio.sleep(1)
         found = kf.get_devices()
 
         found_macs = set(found.keys())
@@ -65,6 +86,7 @@ async def discover_devices(ip: str | None = Param(None)) -> list[pydantic_batch_
             )
 
         await Device.bulk_create(to_create)
+        collection_versions.bump("devices")
         return await pydantic_batch_Device.from_queryset(
             Device.filter(mac__in=new_macs).all()
         )
@@ -0,0 +1,106 @@
+from datetime import datetime
+from typing import Annotated, Any, Literal
+
+from fastapi import APIRouter, Query
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, ConfigDict
+from tortoise.expressions import Q
+
+from server.api._base import decode_cursor, encode_cursor, json_response
+from server.models import Event, EventType
+
+router = APIRouter(prefix="/events", tags=["Events"])
+
+EventField = Literal["id", "tag_id", "type", "loc", "data", "created_at"]
+EVENT_FIELDS: tuple[EventField, ...] = EventField.__args__
+
+
+class pydantic_Event(BaseModel):
+    """Only the requested `fields` are present in list responses."""
+
+    id: int | None = None
+    tag_id: int | None = None
+    type: EventType | None = None
+    loc: str | None = None
+    data: dict[str, Any] | list[Any] | None = None
+    created_at: datetime | None = None
+    model_config = ConfigDict(title="Event")
+
+
+class pydantic_Event_Page(BaseModel):
+    items: list[pydantic_Event]
+    # pass as `cursor` to get the next page, None on the last one
+    next_cursor: str | None
+    model_config = ConfigDict(title="EventPage")
+
+
+@router.get("", response_model=pydantic_Event_Page)
+async def get_events(
+    tag_id: Annotated[list[int] | None, Query()] = None,
+    type: Annotated[list[EventType] | None, Query()] = None,
+    loc: Annotated[list[str] | None, Query()] = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    fields: Annotated[list[EventField] | None, Query()] = None,
+    order: Literal["asc", "desc"] = "desc",
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    cursor: str | None = None,
+):
+    """Events ordered by `(created_at, id)`, a page at a time.
+
+    `since` is inclusive and `until` exclusive.
+
+    Eventually consistent: events that were spilled to the journal while the
+    DB was unavailable are inserted later with their original `created_at`
+    and id, so they can land behind a cursor that already passed them.
+    Incremental readers should overlap, e.g. page again with `since` a few
+    minutes before the newest `created_at` they saw and dedupe by `id`, or
+    use the live stream's `since` replay, which also covers the journal.
+    """
+    q = Event.all()
+    if tag_id:
+        q = q.filter(tag_id__in=tag_id)
+    if type:
+        q = q.filter(type__in=type)
+    if loc:
+        q = q.filter(loc__in=loc)
+    if since is not None:
+        q = q.filter(created_at__gte=since)
+    if until is not None:
+        q = q.filter(created_at__lt=until)
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        try:
+            created_at, id = datetime.fromisoformat(values[0]), int(values[1])
+        except (IndexError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if order == "asc":
+            after = Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=id)
+        else:
+            after = Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=id)
+        q = q.filter(after)
+    sign = "" if order == "asc" else "-"
+    fields = fields or list(EVENT_FIELDS)
+    rows = (
+        await q.order_by(f"{sign}created_at", f"{sign}id")
+        .limit(limit + 1)
+        .values(*{*fields, "created_at", "id"})
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return json_response(
+        {
+            "items": [{f: row[f] for f in fields} for row in rows],
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+@router.get("/{item_id}", response_model=pydantic_Event)
+async def get_event(item_id: int):
+    event = await Event.filter(id=item_id).first().values(*EVENT_FIELDS)
+    if event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return event
@@ -0,0 +1,127 @@
+import csv
+import io
+import json
+from collections.abc import AsyncIterator
+from datetime import datetime
+from typing import Annotated, Any, Literal
+
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+from tortoise.queryset import QuerySet
+
+from server.models import Event, EventType, Tag, TagStatus
+
+router = APIRouter(prefix="/export", tags=["Export"])
+
+ExportFormat = Literal["ndjson", "csv"]
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CHUNK = 2000
+
+TAG_COLUMNS = (
+    "id",
+    "epc",
+    "name",
+    "description",
+    "status",
+    "last_loc_seen_id",
+    "last_active_at",
+    "RSSI",
+    "created_at",
+    "modified_at",
+)
+EVENT_COLUMNS = ("id", "tag_id", "type", "loc", "data", "created_at")
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{value.__class__.__name__} is not JSON serializable")
+
+
+async def _rows(q: QuerySet, columns: tuple[str, ...]) -> AsyncIterator[list[dict]]:
+    """`values()` of `q` in chunks of `EXPORT_CHUNK`, keyset paginated by id."""
+    last_id = None
+    while True:
+        chunk_q = q if last_id is None else q.filter(id__gt=last_id)
+        rows = await chunk_q.order_by("id").limit(EXPORT_CHUNK).values(*columns)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < EXPORT_CHUNK:
+            return
+        last_id = rows[-1]["id"]
+
+
+async def _ndjson(chunks: AsyncIterator[list[dict]]) -> AsyncIterator[str]:
+    async for rows in chunks:
+        yield "".join(
+            json.dumps(row, default=_json_default, separators=(",", ":")) + "\n"
+            for row in rows
+        )
+
+
+async def _csv(
+    chunks: AsyncIterator[list[dict]], columns: tuple[str, ...]
+) -> AsyncIterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield buf.getvalue()
+    async for rows in chunks:
+        buf.seek(0)
+        buf.truncate()
+        for row in rows:
+            writer.writerow(
+                [
+                    (
+                        v.isoformat()
+                        if isinstance(v, datetime)
+                        else json.dumps(v) if isinstance(v, (dict, list)) else v
+                    )
+                    for v in (row[c] for c in columns)
+                ]
+            )
+        yield buf.getvalue()
+
+
+def _export(
+    name: str, q: QuerySet, columns: tuple[str, ...], format: ExportFormat
+) -> StreamingResponse:
+    chunks = _rows(q, columns)
+    body = _ndjson(chunks) if format == "ndjson" else _csv(chunks, columns)
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'},
+    )
+
+
+@router.get("/tags", description="Stream all tags as NDJSON or CSV")
+async def export_tags(
+    format: ExportFormat = "ndjson",
+    status: Annotated[list[TagStatus] | None, Query()] = None,
+):
+    q = Tag.all()
+    if status:
+        q = q.filter(status__in=status)
+    return _export("tags", q, TAG_COLUMNS, format)
+
+
+@router.get("/events", description="Stream events as NDJSON or CSV, oldest first")
+async def export_events(
+    format: ExportFormat = "ndjson",
+    tag_id: Annotated[list[int] | None, Query()] = None,
+    type: Annotated[list[EventType] | None, Query()] = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+):
+    q = Event.all()
+    if tag_id:
+        q = q.filter(tag_id__in=tag_id)
+    if type:
+        q = q.filter(type__in=type)
+    if since is not None:
+        q = q.filter(created_at__gte=since)
+    if until is not None:
+        q = q.filter(created_at__lt=until)
+    return _export("events", q, EVENT_COLUMNS, format)
@@ -0,0 +1,165 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+from typing import Any, Literal
+from uuid import uuid4
+
+from fastapi import APIRouter
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel
+
+from server.api.configure import sync_locations
+from server.core import FLEET_CONCURRENCY
+from server.logging import get_configured_logger
+from server.models import Device
+from server.utils.KEONN_interface import (
+    API,
+    configure_keonn,
+    make_sound,
+    mqtt_service_config,
+    restart_device,
+)
+
+logger = get_configured_logger(__name__, "DEBUG")
+router = APIRouter(prefix="/fleet", tags=["Fleet"])
+
+FleetAction = Literal["configure", "restart", "locations", "beep"]
+
+
+async def _configure(device_id: int, ip: str) -> dict[str, Any]:
+    pushed = await configure_keonn(API(ip))
+    return {"config": mqtt_service_config().digest[:12], "pushed": pushed}
+
+
+async def _restart(device_id: int, ip: str) -> str:
+    await restart_device(API(ip))
+    return "Restarted"
+
+
+async def _beep(device_id: int, ip: str) -> str:
+    await make_sound(API(ip))
+    return "Beeped"
+
+
+ACTIONS: dict[str, Callable[[int, str], Awaitable[Any]]] = {
+    "configure": _configure,
+    "restart": _restart,
+    "locations": sync_locations,
+    "beep": _beep,
+}
+
+
+class DeviceProgress(BaseModel):
+    status: Literal["pending", "running", "done", "failed"] = "pending"
+    result: Any = None
+    error: str | None = None
+
+
+class FleetJob(BaseModel):
+    id: str
+    action: FleetAction
+    created_at: datetime
+    finished_at: datetime | None = None
+    devices: dict[int, DeviceProgress]
+
+
+class FleetRequest(BaseModel):
+    devices: list[int] | None = None  # all of them if not given
+
+
+class FleetJobs:
+    """Runs fleet jobs in the background and keeps the last `keep` of them.
+
+    At most `concurrency` devices are worked on at once, across all jobs.
+    """
+
+    def __init__(self, concurrency: int, keep: int = 100) -> None:
+        self.__jobs: OrderedDict[str, FleetJob] = OrderedDict()
+        self.__tasks: set[asyncio.Task] = set()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.keep = keep
+
+    def start(self, action: FleetAction, ips: dict[int, str]) -> FleetJob:
+        job = FleetJob(
+            id=uuid4().hex,
+            action=action,
+            created_at=datetime.now(timezone.utc),
+            devices={device_id: DeviceProgress() for device_id in ips},
+        )
+        self.__jobs[job.id] = job
+        while len(self.__jobs) > self.keep:
+            self.__jobs.popitem(last=False)
+        task = asyncio.create_task(self._run(job, ips))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return job
+
+    async def _run(self, job: FleetJob, ips: dict[int, str]) -> None:
+        await asyncio.gather(
+            *(self._run_one(job, device_id, ip) for device_id, ip in ips.items())
+        )
+        job.finished_at = datetime.now(timezone.utc)
+        failed = [id for id, p in job.devices.items() if p.status == "failed"]
+        logger.info(
+            f"Fleet {job.action} {job.id} done on {len(ips)} devices, failed: {failed}"
+        )
+
+    async def _run_one(self, job: FleetJob, device_id: int, ip: str) -> None:
+        progress = job.devices[device_id]
+        async with self.semaphore:
+            progress.status = "running"
+            try:
+                progress.result = await ACTIONS[job.action](device_id, ip)
+                progress.status = "done"
+            except Exception as e:
+                progress.status = "failed"
+                progress.error = str(e) or e.__class__.__name__
+                logger.warning(f"Fleet {job.action} failed on {device_id=}: {e!r}")
+
+    def get(self, job_id: str) -> FleetJob | None:
+        return self.__jobs.get(job_id)
+
+    def recent(self) -> list[FleetJob]:
+        return list(reversed(self.__jobs.values()))
+
+    async def aclose(self) -> None:
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+
+fleet_jobs = FleetJobs(FLEET_CONCURRENCY)
+
+
+@router.post(
+    "/{action}",
+    status_code=202,
+    description="Start `action` on the given devices (all of them by default), "
+    "poll the returned job for progress",
+)
+async def start_job(action: FleetAction, request: FleetRequest) -> FleetJob:
+    q = Device.all()
+    if request.devices is not None:
+        q = q.filter(id__in=request.devices)
+    ips = dict(await q.values_list("id", "ip"))
+    if request.devices is not None:
+        missing = set(request.devices) - ips.keys()
+        if missing:
+            raise HTTPException(
+                status_code=404, detail=f"Devices not found: {sorted(missing)}"
+            )
+    return fleet_jobs.start(action, ips)
+
+
+@router.get("/jobs")
+async def get_jobs() -> list[FleetJob]:
+    return fleet_jobs.recent()
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> FleetJob:
+    job = fleet_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
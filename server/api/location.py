@@ -1,27 +1,110 @@
-from fastapi import APIRouter
-from pydantic import BaseModel, ConfigDict
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Query, Request
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, ConfigDict, Field, PositiveFloat
 from tortoise.contrib.pydantic import pydantic_model_creator
 
-from server.api._base import add_get_all, add_get_one, add_patch
-from server.models import Location
+from server.api._base import (
+    Embedded,
+    _columns,
+    _item,
+    _values,
+    add_get_all,
+    add_patch,
+    encode_cursor,
+    json_response,
+)
+from server.api.tag import batch_columns as tag_columns
+from server.api.tag import pydantic_batch_Tag
+from server.core.state import collection_versions, location_index
+from server.models import Location, Tag
 
 router = APIRouter(prefix="/locations", tags=["Locations"])
 
-pydantic_Location = pydantic_model_creator(
-    Location, name="Location", exclude=("tags.events",)
-)
+
+class pydantic_Location(
+    pydantic_model_creator(Location, name="Location_fields", exclude=("tags",))
+):
+    tags: Embedded[pydantic_batch_Tag] | None = None  # type: ignore
+    model_config = ConfigDict(title="Location")
+
+
+location_columns = _columns(pydantic_Location)
+del location_columns["tags"]
 pydantic_batch_Location = pydantic_model_creator(
     Location,
     name="Location_batch",
-    include=("device_id", "name", "id"),
+    include=("device_id", "name", "id", "lost_threshold"),
 )
 
 
 class pydantic_Update_Location(BaseModel):
-    name: str
+    name: str = Field(None)  # may be left out, but not null
+    lost_threshold: PositiveFloat | None = None
     model_config = ConfigDict(title="UpdateLocation")
 
 
-add_get_all(router, pydantic_batch_Location, Location.all)
-add_get_one(router, pydantic_Location, int, Location.get)
-add_patch(router, pydantic_batch_Location, pydantic_Update_Location, Location)
+def on_location_change():
+    location_index.invalidate()
+    # tags embed their location
+    collection_versions.bump("locations", "tags")
+
+
+add_get_all(
+    router,
+    pydantic_batch_Location,
+    Location.all,
+    filters={"location": (str, "loc__in"), "device": (int, "device_id__in")},
+    collection="locations",
+)
+
+
+@router.get(
+    "/{item_id}",
+    response_model=pydantic_Location,
+    description="`expand=tags` embeds the tags last seen there, "
+    "`embed_limit` at a time and most recently created (highest id) first",
+)
+async def get_one(
+    request: Request,
+    item_id: int,
+    expand: Annotated[list[Literal["tags"]] | None, Query()] = None,
+    embed_limit: Annotated[int, Query(ge=1, le=1000)] = 20,
+):
+    row = await Location.filter(id=item_id).first().values(*_values(location_columns))
+    if row is None:
+        raise HTTPException(status_code=404, detail="Location not found")
+    location = _item(row, location_columns)
+    if expand and "tags" in expand:
+        tags = (
+            await Tag.filter(last_loc_seen_id=location["loc"])
+            .order_by("-id")
+            .limit(embed_limit + 1)
+            .values(*_values(tag_columns))
+        )
+        next = None
+        if len(tags) > embed_limit:
+            tags = tags[:embed_limit]
+            next = str(
+                request.url_for("tags_list").include_query_params(
+                    location=location["loc"],
+                    order="desc",
+                    limit=embed_limit,
+                    cursor=encode_cursor(tags[-1]["id"]),
+                )
+            )
+        location["tags"] = {
+            "items": [_item(tag, tag_columns) for tag in tags],
+            "next": next,
+        }
+    return json_response(location)
+
+
+add_patch(
+    router,
+    pydantic_batch_Location,
+    pydantic_Update_Location,
+    Location,
+    on_change=on_location_change,
+)
@@ -1,14 +1,30 @@
-from fastapi import APIRouter
-from pydantic import BaseModel, ConfigDict
+from typing import Annotated, Any, Literal
+
+from fastapi import APIRouter, Query, Request
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, ConfigDict, Field
 from tortoise.contrib.pydantic import pydantic_model_creator
+from tortoise.expressions import Q
+from tortoise.transactions import in_transaction
 
-from server.api._base import add_get_all, add_get_one, add_patch
-from server.models import Tag
+from server.api._base import (
+    Embedded,
+    _columns,
+    _item,
+    _values,
+    add_get_all,
+    decode_cursor,
+    encode_cursor,
+    forward_exception,
+    json_response,
+)
+from server.api.event import EVENT_FIELDS, pydantic_Event
+from server.core.state import collection_versions, tag_versions
+from server.models import Event, Tag, TagStatus
 
 router = APIRouter(prefix="/tags", tags=["Tags"])
 
 
-pydantic_Tag = pydantic_model_creator(Tag, name="Tag")
 pydantic_batch_Tag = pydantic_model_creator(
     Tag,
     name="Tag_batch",
@@ -16,16 +32,126 @@ pydantic_batch_Tag = pydantic_model_creator(
 )
 
 
+class pydantic_Tag(pydantic_batch_Tag):  # type: ignore
+    events: Embedded[pydantic_Event] | None = None
+    model_config = ConfigDict(title="Tag")
+
+
 class pydantic_Update_Tag(BaseModel):
-    name: str | None = None
-    description: str | None = None
+    name: str = Field(None)
+    description: str = Field(None)
     model_config = ConfigDict(title="UpdateTag")
 
 
-def batch_tags_query():
-    return Tag.all().prefetch_related("last_loc_seen")
+class pydantic_Tag_Changes(BaseModel):
+    items: list[pydantic_batch_Tag]  # type: ignore
+    # pass as `since` to get the changes after these
+    next_cursor: str
+    has_more: bool
+    model_config = ConfigDict(title="TagChanges")
+
+
+add_get_all(
+    router,
+    pydantic_batch_Tag,
+    Tag.all,
+    filters={
+        "status": (TagStatus, "status__in"),
+        "location": (str, "last_loc_seen_id__in"),
+        "device": (int, "last_loc_seen__device_id__in"),
+    },
+    collection="tags",
+)
+
+batch_columns = _columns(pydantic_batch_Tag)
+
+
+@router.get(
+    "/changes",
+    response_model=pydantic_Tag_Changes,
+    description="Tags whose status, location or name changed since the cursor, "
+    "all tags without one",
+)
+async def get_changes(
+    since: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=10_000)] = 1000,
+):
+    q = Tag.all()
+    if since is not None:
+        values = decode_cursor(since)
+        try:
+            version, id = int(values[0]), int(values[1])
+        except (IndexError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        q = q.filter(Q(version__gt=version) | Q(version=version, id__gt=id))
+    rows = (
+        await q.order_by("version", "id")
+        .limit(limit + 1)
+        .values(*_values(batch_columns))
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        next_cursor = encode_cursor(rows[-1]["version"], rows[-1]["id"])
+    else:
+        next_cursor = since or encode_cursor(0, 0)
+    return json_response(
+        {
+            "items": [_item(row, batch_columns) for row in rows],
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+        }
+    )
+
+
+@router.get(
+    "/{item_id}",
+    response_model=pydantic_Tag,
+    description="`expand=events` embeds the newest `embed_limit` events",
+)
+async def get_one(
+    request: Request,
+    item_id: int,
+    expand: Annotated[list[Literal["events"]] | None, Query()] = None,
+    embed_limit: Annotated[int, Query(ge=1, le=1000)] = 20,
+):
+    row = await Tag.filter(id=item_id).first().values(*_values(batch_columns))
+    if row is None:
+        raise HTTPException(status_code=404, detail="Tag not found")
+    tag = _item(row, batch_columns)
+    if expand and "events" in expand:
+        events = (
+            await Event.filter(tag_id=item_id)
+            .order_by("-created_at", "-id")
+            .limit(embed_limit + 1)
+            .values(*EVENT_FIELDS)
+        )
+        next = None
+        if len(events) > embed_limit:
+            events = events[:embed_limit]
+            cursor = encode_cursor(events[-1]["created_at"], events[-1]["id"])
+            next = str(
+                request.url_for("get_events").include_query_params(
+                    tag_id=item_id, limit=embed_limit, cursor=cursor
+                )
+            )
+        tag["events"] = {"items": events, "next": next}
+    return json_response(tag)
+
+
+async def update_tag(item_id: int, changes: dict[str, Any]) -> None:
+    """Update a tag and give it a new version, so /changes shows it."""
+    async with in_transaction():
+        await Tag.filter(id=item_id).update(
+            **changes, version=await tag_versions.next()
+        )
+    collection_versions.bump("tags")
 
 
-add_get_all(router, pydantic_batch_Tag, batch_tags_query)
-add_get_one(router, pydantic_Tag, int, Tag.get)
-add_patch(router, pydantic_batch_Tag, pydantic_Update_Tag, Tag)
+@router.patch("/{item_id}", response_model=pydantic_batch_Tag)
+async def update(item_id: int, item: pydantic_Update_Tag):
+    try:
+        await update_tag(item_id, item.model_dump(exclude_unset=True))
+        return await pydantic_batch_Tag.from_queryset_single(Tag.get(id=item_id))
+    except Exception as e:
+        forward_exception(e)
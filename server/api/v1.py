@@ -1,7 +1,10 @@
 from fastapi import APIRouter
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 from tortoise.contrib.pydantic import pydantic_model_creator
 
+from server.api.device import on_device_change
+from server.api.location import on_location_change
+from server.api.tag import update_tag as apply_tag_update
 from server.models import Device, Location, Tag, Event
 
 pydantic_Device = pydantic_model_creator(
@@ -21,8 +24,8 @@ pydantic_Create_Device = pydantic_model_creator(
 
 
 class pydantic_Update_Device(BaseModel):
-    name: str | None = None
-    ip: str | None = None
+    name: str = Field(None)
+    ip: str = Field(None)
     model_config = ConfigDict(title="UpdateDevice")
 
 
@@ -39,9 +42,9 @@ def add_devices(router: APIRouter) -> None:
 
     @router.post("/devices", tags=tags)
     async def create_device(device: pydantic_Create_Device) -> pydantic_Device:  # type: ignore
-        return await pydantic_Device.from_tortoise_orm(
-            await Device.create(**device.dict())
-        )
+        created = await Device.create(**device.dict())
+        on_device_change()
+        return await pydantic_Device.from_tortoise_orm(created)
 
     @router.patch("/devices/{item_id}", tags=tags)
     async def update_device(
@@ -49,6 +52,7 @@ def add_devices(router: APIRouter) -> None:
         device: pydantic_Update_Device,  # type: ignore
     ) -> pydantic_Device:  # type: ignore
         await Device.filter(id=item_id).update(**device.model_dump(exclude_unset=True))
+        on_device_change()
         return await pydantic_Device.from_queryset_single(Device.get(id=item_id))
 
 
@@ -61,8 +65,8 @@ pydantic_batch_Tag = pydantic_model_creator(
 
 
 class pydantic_Update_Tag(BaseModel):
-    name: str | None = None
-    description: str | None = None
+    name: str = Field(None)
+    description: str = Field(None)
 
 
 def add_tags(router: APIRouter) -> None:
@@ -80,7 +84,7 @@ def add_tags(router: APIRouter) -> None:
 
     @router.patch("/tags/{item_id}", tags=tags)
     async def update_tag(item_id: int, tag: pydantic_Update_Tag) -> pydantic_Tag:  # type: ignore
-        await Tag.filter(id=item_id).update(**tag.dict(exclude_unset=True))
+        await apply_tag_update(item_id, tag.model_dump(exclude_unset=True))
         return await pydantic_Tag.from_queryset_single(Tag.get(id=item_id))
 
 
@@ -117,9 +121,9 @@ def add_locations(router: APIRouter) -> None:
 
     @router.post("/locations", tags=tags)
     async def create_location(location: pydantic_Create_Location) -> pydantic_Location:  # type: ignore
-        return await pydantic_Location.from_tortoise_orm(
-            await Location.create(**location.model_dump())
-        )
+        created = await Location.create(**location.model_dump())
+        on_location_change()
+        return await pydantic_Location.from_tortoise_orm(created)
 
     @router.patch("/locations/{item_id}", tags=tags)
     async def update_location(
@@ -129,6 +133,7 @@ def add_locations(router: APIRouter) -> None:
         await Location.filter(id=item_id).update(
             **location.model_dump(exclude_unset=True)
         )
+        on_location_change()
         return await pydantic_Location.from_queryset_single(Location.get(id=item_id))
 
 
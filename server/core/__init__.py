@@ -1,6 +1,46 @@
 import os
+import pathlib as pl
 
 LOST_THRESHOLD = 5.0
+# upper bound on how long monitor_lost sleeps between deadline checks
+LOST_CHECK_INTERVAL = 1.0
+# a reader without status pings or reads for this long is offline, its tags are
+# not reported lost one by one; keep it above the RFID/status ping period
+DEVICE_OFFLINE_AFTER = float(os.environ.get("DEVICE_OFFLINE_AFTER", 10))
+
+# reads from all readers are merged for up to this long before hitting the DB
+INGEST_BATCH_WINDOW = float(os.environ.get("INGEST_BATCH_WINDOW_MS", 250)) / 1000
+INGEST_BATCH_MAX_READS = int(os.environ.get("INGEST_BATCH_MAX_READS", 5000))
+# reads that only refresh last_active_at/RSSI are written to the DB this often
+HEARTBEAT_FLUSH_INTERVAL = float(os.environ.get("HEARTBEAT_FLUSH_INTERVAL", 30))
+
+# event_sink writes up to EVENT_BATCH_SIZE events at once, waiting at most
+# EVENT_BATCH_LINGER seconds for a batch to fill up
+EVENT_BATCH_SIZE = int(os.environ.get("EVENT_BATCH_SIZE", 1000))
+EVENT_BATCH_LINGER = float(os.environ.get("EVENT_BATCH_LINGER_MS", 500)) / 1000
+# events waiting for the sink; when full, producers "block" or "drop_oldest"
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", 50_000))
+EVENT_QUEUE_POLICY = os.environ.get("EVENT_QUEUE_POLICY", "block")
+# batches go to the on-disk journal while the DB is down or this many are queued
+EVENT_SPILL_AT = int(EVENT_QUEUE_SIZE * 0.8)
+EVENT_JOURNAL_DIR = pl.Path(os.environ.get("EVENT_JOURNAL_DIR", "event_journal"))
+EVENT_SINK_REPORT_INTERVAL = 60.0
+
+# frames buffered per /ws/mqtt client; when full "drop" the oldest or "disconnect"
+WS_CLIENT_QUEUE_SIZE = int(os.environ.get("WS_CLIENT_QUEUE_SIZE", 1000))
+WS_SLOW_CLIENT_POLICY = os.environ.get("WS_SLOW_CLIENT_POLICY", "drop")
+WS_REPLAY_BUFFER = int(os.environ.get("WS_REPLAY_BUFFER", 10_000))
+WS_REPLAY_LIMIT = int(os.environ.get("WS_REPLAY_LIMIT", 50_000))
+
+# HTTP sessions to the readers' REST API (port 3161)
+KEONN_TIMEOUT = float(os.environ.get("KEONN_TIMEOUT", 10))
+KEONN_CONNECT_TIMEOUT = float(os.environ.get("KEONN_CONNECT_TIMEOUT", 3))
+KEONN_MAX_CONNECTIONS = int(os.environ.get("KEONN_MAX_CONNECTIONS", 4))
+KEONN_KEEPALIVE_EXPIRY = float(os.environ.get("KEONN_KEEPALIVE_EXPIRY", 30))
+# how long a reader's /devices descriptor is reused
+KEONN_DESCRIPTOR_TTL = float(os.environ.get("KEONN_DESCRIPTOR_TTL", 60))
+# readers worked on at once by /fleet jobs
+FLEET_CONCURRENCY = int(os.environ.get("FLEET_CONCURRENCY", 16))
 
 
 KEONN_BROKER_CONF = {
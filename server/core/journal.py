@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import pathlib as pl
+from datetime import datetime
+from typing import IO
+
+from server.core import EVENT_JOURNAL_DIR
+from server.logging import get_configured_logger
+from server.models import EventType, TagEvent
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    import msvcrt
+
+    fcntl = None
+
+logger = get_configured_logger(__name__, "DEBUG")
+
+
+def _dump_event(e: TagEvent) -> str:
+    return json.dumps(
+        {
+            "id": e.id,
+            "tag_id": e.tag_id,
+            "type": int(e.type),
+            "data": e.data,
+            "created_at": e.created_at.isoformat(),
+            "loc": e.loc,
+            "epc": e.epc,
+        },
+        separators=(",", ":"),
+    )
+
+
+def _load_event(line: str) -> TagEvent:
+    d = json.loads(line)
+    return TagEvent(
+        type=EventType(d["type"]),
+        tag_id=d["tag_id"],
+        data=d["data"],
+        created_at=datetime.fromisoformat(d["created_at"]),
+        loc=d.get("loc"),
+        id=d.get("id"),
+        epc=d.get("epc"),
+    )
+
+
+class EventJournal:
+    """Append-only, segmented NDJSON journal of events that did not reach the DB.
+
+    Every `append` is one write and one fsync. Segments are rotated after
+    `segment_size` bytes and are replayed oldest first, a replayed segment is
+    deleted once the caller has stored its events.
+    """
+
+    def __init__(self, directory: pl.Path, segment_size: int = 16 * 2**20) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = asyncio.Lock()
+        self.__file: IO[str] | None = None
+        self.__seq = 0
+        self.__segments: list[pl.Path] = []  # oldest first, incl. the open one
+        self.__claim: IO[str] | None = None
+        self.loaded = False
+
+    def claim(self) -> bool:
+        """Lock the journal for this process, False if another process has it.
+
+        `EventIds` hands out event ids in memory, so only one process may ingest
+        and sink events. The OS releases the lock when the process exits.
+        """
+        if self.__claim is not None:
+            return True
+        self.directory.mkdir(parents=True, exist_ok=True)
+        f = open(self.directory / "ingest.lock", "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self.__claim = f
+        return True
+
+    def _segment(self, seq: int) -> pl.Path:
+        return self.directory / f"events-{seq:012}.ndjson"
+
+    def _load(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.__segments = sorted(self.directory.glob("events-*.ndjson"))
+        if self.__segments:
+            self.__seq = int(self.__segments[-1].stem.split("-")[1]) + 1
+            logger.warning(f"{len(self.__segments)} journal segments left to replay")
+        self.loaded = True
+
+    def _append(self, lines: str) -> None:
+        if not self.loaded:
+            self._load()
+        if self.__file is None or self.__file.tell() >= self.segment_size:
+            self._rotate()
+        assert self.__file is not None
+        self.__file.write(lines)
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+    def _rotate(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        path = self._segment(self.__seq)
+        self.__seq += 1
+        self.__file = open(path, "a", encoding="utf-8")
+        self.__segments.append(path)
+
+    async def append(self, events: list[TagEvent]) -> None:
+        lines = "".join(_dump_event(e) + "\n" for e in events)
+        async with self.lock:
+            await asyncio.to_thread(self._append, lines)
+        logger.warning(f"Spilled {len(events)} events to the journal")
+
+    def __bool__(self) -> bool:
+        """True if there are events waiting for replay."""
+        if not self.loaded:
+            self._load()
+        return bool(self.__segments)
+
+    async def oldest(self) -> tuple[pl.Path, list[TagEvent]] | None:
+        """Close the oldest segment for writing and return its events."""
+        async with self.lock:
+            if not self:
+                return None
+            path = self.__segments[0]
+            if self.__file is not None and len(self.__segments) == 1:
+                self.__file.close()
+                self.__file = None
+        text = await asyncio.to_thread(path.read_text, encoding="utf-8")
+        # a crash in the middle of a write can leave a partial last line
+        events = []
+        for line in text.splitlines():
+            try:
+                events.append(_load_event(line))
+            except ValueError:
+                logger.error(f"Skipping corrupt journal line in {path.name}: {line!r}")
+        return path, events
+
+    def _max_id(self) -> int:
+        max_id = 0
+        for path in list(self.__segments):
+            for line in path.read_text(encoding="utf-8").splitlines():
+                try:
+                    max_id = max(max_id, _load_event(line).id or 0)
+                except ValueError:
+                    continue
+        return max_id
+
+    def _between(self, after: int, before: int | None) -> list[TagEvent]:
+        events = []
+        for path in list(self.__segments):
+            try:
+                text = path.read_text(encoding="utf-8")
+            except FileNotFoundError:  # replayed in the meantime
+                continue
+            for line in text.splitlines():
+                try:
+                    e = _load_event(line)
+                except ValueError:
+                    continue
+                if (
+                    e.id is not None
+                    and e.id > after
+                    and (before is None or e.id < before)
+                ):
+                    events.append(e)
+        return events
+
+    async def between(self, after: int, before: int | None = None) -> list[TagEvent]:
+        """Events waiting for replay with `after` < id < `before`."""
+        if not self:
+            return []
+        return await asyncio.to_thread(self._between, after, before)
+
+    async def max_id(self) -> int:
+        """Highest event id waiting for replay, 0 if none."""
+        if not self:
+            return 0
+        return await asyncio.to_thread(self._max_id)
+
+    async def remove(self, path: pl.Path) -> None:
+        async with self.lock:
+            self.__segments.remove(path)
+            await asyncio.to_thread(path.unlink, missing_ok=True)
+
+    async def aclose(self) -> None:
+        async with self.lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+
+journal = EventJournal(EVENT_JOURNAL_DIR)
@@ -1,32 +1,69 @@
 import asyncio
 import ipaddress
+import time
 from collections.abc import Callable, Coroutine
-from contextlib import suppress
-from datetime import datetime, timedelta, timezone
+from contextlib import aclosing
+from dataclasses import replace
+from datetime import datetime, timezone
 from functools import wraps
 
 import aiomqtt
+from tortoise.transactions import in_transaction
 
-from server.core import KEONN_BROKER_CONF, LOST_THRESHOLD
-from server.core.parser import keonn_revents_stream
+from server.core import (
+    EVENT_BATCH_LINGER,
+    EVENT_BATCH_SIZE,
+    EVENT_QUEUE_POLICY,
+    EVENT_QUEUE_SIZE,
+    EVENT_SINK_REPORT_INTERVAL,
+    EVENT_SPILL_AT,
+    HEARTBEAT_FLUSH_INTERVAL,
+    INGEST_BATCH_MAX_READS,
+    INGEST_BATCH_WINDOW,
+    KEONN_BROKER_CONF,
+    LOST_CHECK_INTERVAL,
+)
+from server.core.journal import journal
+from server.core.parser import ReadEvent, coalesce_revents, keonn_revents_stream
+from server.core.sink import EventIds, EventQueue, SinkStats
+from server.core.state import (
+    TagState,
+    collection_versions,
+    device_liveness,
+    loc_mac,
+    location_index,
+    tag_index,
+    tag_versions,
+)
 from server.logging import get_configured_logger
 from server.models import (
     Device,
     Event,
     EventType,
-    Location,
     Tag,
     TagEvent,
     TagStatus,
 )
 from server.utils.proxy_fastapi import update_ip
+from server.websockets.hub import hub
 
 logger = get_configured_logger(__name__, "DEBUG")
 
-equeue = asyncio.Queue()
+equeue = EventQueue(EVENT_QUEUE_SIZE, EVENT_QUEUE_POLICY)
+event_ids = EventIds()
+# after a failed insert event_sink goes straight to the journal for a while
+EVENT_SINK_BACKOFF = 5.0
+sink_backoff_until = 0.0
+sink_stats = SinkStats()
+
+# location_index.version the lost deadlines were computed with
+thresholds_version = 0
 
 seconds = float
 
+TAG_STATE_FIELDS = ["last_loc_seen_id", "last_active_at", "status", "RSSI", "version"]
+HEARTBEAT_FIELDS = ["last_active_at", "RSSI"]
+
 
 def loop(w8_after_exc: seconds = 1):
     def decorator(func: Callable[..., Coroutine]):
@@ -49,50 +86,405 @@ def loop(w8_after_exc: seconds = 1):
     return decorator
 
 
+def expired_tags(now: float) -> tuple[list[TagState], dict[str, list[TagState]]]:
+    """Pop the tags whose lost deadline has passed, rescheduling refreshed ones.
+
+    Returns:
+        tuple: lost tags and the tags of offline readers grouped by MAC.
+    """
+    lost: list[TagState] = []
+    offline: dict[str, list[TagState]] = {}
+    for id in tag_index.deadlines.pop_expired(now):
+        state = tag_index.by_id(id)
+        if state is None or state.status == TagStatus.LOST:
+            continue
+        if state.status == TagStatus.ACTIVE and tag_index.lost_deadline(state) > now:
+            # read again since it was scheduled
+            tag_index.schedule(state)
+            continue
+        if state.loc is None:
+            lost.append(state)
+            continue
+        mac = loc_mac(state.loc)
+        silent_for = now - device_liveness.last_seen(mac)
+        if silent_for < tag_index.threshold(state):
+            # the reader is talking, just not about this tag
+            lost.append(state)
+        elif silent_for < device_liveness.offline_after:
+            # the whole reader went quiet, decide once it is known to be offline
+            tag_index.deadlines.schedule(
+                id, device_liveness.last_seen(mac) + device_liveness.offline_after
+            )
+        else:
+            offline.setdefault(mac, []).append(state)
+    return lost, offline
+
+
+async def returned_readers(now: float) -> list[TagEvent]:
+    """Give the tags of readers that came back one threshold to be read again."""
+    returned = device_liveness.pop_returned()
+    if not returned:
+        return []
+    counts = dict.fromkeys(returned, 0)
+    for state in tag_index:
+        if state.status == TagStatus.READER_OFFLINE and state.loc:
+            mac = loc_mac(state.loc)
+            if mac in returned:
+                tag_index.deadlines.schedule(state.id, now + tag_index.threshold(state))
+                counts[mac] += 1
+    await Device.filter(mac__in=returned).update(online=True)
+    collection_versions.bump("devices")
+    logger.info(f"Readers back online: {counts}")
+    return [
+        TagEvent(
+            type=EventType.READER_ONLINE,
+            tag_id=None,
+            data={"device": mac, "tags": n},
+        )
+        for mac, n in counts.items()
+    ]
+
+
 @loop(3)
 async def monitor_lost():
-    await asyncio.sleep(LOST_THRESHOLD)
-    dtime = datetime.now(timezone.utc) - timedelta(seconds=LOST_THRESHOLD)
-    qlost = (
-        Tag.filter(last_active_at__lte=dtime)
-        .exclude(status=TagStatus.LOST)
-        .prefetch_related("last_loc_seen")
-        .all()
+    global thresholds_version
+    await tag_index.ensure_loaded()
+    if not device_liveness.loaded:
+        await device_liveness.load()
+    await location_index.resolve(())
+    if location_index.version != thresholds_version:
+        async with tag_index.lock:
+            thresholds_version = location_index.version
+            tag_index.reschedule_all()
+    next_deadline = tag_index.deadlines.next_deadline()
+    now = time.time()
+    await asyncio.sleep(
+        LOST_CHECK_INTERVAL
+        if next_deadline is None
+        else min(max(next_deadline - now, 0), LOST_CHECK_INTERVAL)
     )
-    lost = await qlost
+    # the index is the only place with up to date last_active_at,
+    # heartbeats reach the DB only every HEARTBEAT_FLUSH_INTERVAL
+    async with tag_index.lock:
+        now = time.time()
+        tevents = await returned_readers(now)
+        lost, offline = expired_tags(now)
+        offline_tags = [s for states in offline.values() for s in states]
+        # Update statuses in DB in single query each, by pk
+        try:
+            async with in_transaction():
+                version = await tag_versions.next() if lost or offline_tags else 0
+                if lost:
+                    await Tag.filter(id__in=[s.id for s in lost]).update(
+                        status=TagStatus.LOST, version=version
+                    )
+                if offline_tags:
+                    await Tag.filter(id__in=[s.id for s in offline_tags]).update(
+                        status=TagStatus.READER_OFFLINE, version=version
+                    )
+                    await Device.filter(mac__in=offline.keys()).update(online=False)
+        except Exception:
+            for state in (*lost, *offline_tags):
+                tag_index.deadlines.schedule(state.id, now)
+            raise
+        for state in lost:
+            state.status = TagStatus.LOST
+        for state in offline_tags:
+            state.status = TagStatus.READER_OFFLINE
+        if lost or offline_tags:
+            collection_versions.bump("tags")
+        if offline:
+            collection_versions.bump("devices")
+        newly_offline = [mac for mac in offline if device_liveness.mark_offline(mac)]
+
     if lost:
-        # Update status in DB to LOST in single query
         logger.debug(
-            f"{datetime.now(timezone.utc).strftime('%H:%M:%S')}: Marked {await qlost.update(status=TagStatus.LOST)} tags as LOST"
+            f"{datetime.now(timezone.utc).strftime('%H:%M:%S')}: Marked {len(lost)} tags as LOST"
         )
-        tevents = [
+        tevents += [
             TagEvent(
                 type=EventType.TAG_LOST,
-                tag=t,
-                data={
-                    "from": t.last_loc_seen and t.last_loc_seen.loc,
-                    "RSSI": t.RSSI,
-                },
+                tag_id=s.id,
+                data={"from": s.loc, "RSSI": s.RSSI},
+                epc=s.epc,
+                loc=s.loc,
             )
-            for t in lost
+            for s in lost
         ]
-        logger.debug(
-            f"Adding {len(tevents)} lost events for tags {[tag.epc for tag in lost]}"
+        logger.debug(f"Adding {len(lost)} lost events for tags {[s.epc for s in lost]}")
+    if offline:
+        logger.warning(
+            f"Readers offline: { {mac: len(states) for mac, states in offline.items()} }"
         )
+        tevents += [
+            TagEvent(
+                type=EventType.READER_OFFLINE,
+                tag_id=None,
+                data={"device": mac, "tags": len(offline[mac])},
+            )
+            for mac in newly_offline
+        ]
+    if tevents:
         await equeue.put(tevents)
 
 
 @loop()
-async def event_sink():
-    evts: list[TagEvent] = await equeue.get()
+async def flush_heartbeats():
+    """Write-behind of reads that only refreshed `last_active_at`/`RSSI`.
+
+    The lifespan calls `write_heartbeats` once more on shutdown.
+    """
+    await asyncio.sleep(HEARTBEAT_FLUSH_INTERVAL)
+    await write_heartbeats()
+
+
+async def write_heartbeats() -> None:
+    async with tag_index.lock:
+        dirty = tag_index.pop_dirty()
+        if not dirty:
+            return
+        try:
+            await Tag.bulk_update(
+                [
+                    Tag(id=s.id, last_active_at=s.last_active_at, RSSI=s.RSSI)
+                    for s in dirty
+                ],
+                fields=HEARTBEAT_FIELDS,
+            )
+        except Exception:
+            for state in dirty:
+                tag_index.mark_dirty(state)
+            raise
+        collection_versions.bump("tags")
+    logger.debug(f"Flushed heartbeats of {len(dirty)} tags")
+
+
+async def store_events(evts: list[TagEvent], ignore_conflicts: bool = False) -> None:
+    start = time.perf_counter()
     await Event.bulk_create(
-        [Event(tag=e.tag, type=e.type, data=e.data, notified=False) for e in evts]
+        [
+            Event(
+                id=e.id,
+                tag_id=e.tag_id,
+                type=e.type,
+                data=e.data,
+                notified=False,
+                created_at=e.created_at,
+                loc=e.loc,
+            )
+            for e in evts
+        ],
+        ignore_conflicts=ignore_conflicts,
     )
-    logger.info(f"Sinking {len(evts)} events")
+    sink_stats.record(len(evts), time.perf_counter() - start)
+
+
+@loop()
+async def event_sink():
+    global sink_backoff_until
+    await event_ids.ensure_loaded(journal)
+    evts = await equeue.get_batch(EVENT_BATCH_SIZE, EVENT_BATCH_LINGER)
+    event_ids.assign(evts)
+    hub.publish(evts)
+    if len(equeue) >= EVENT_SPILL_AT or time.monotonic() < sink_backoff_until:
+        # DB is down or behind, replay_journal stores these later
+        await journal.append(evts)
+    else:
+        try:
+            await store_events(evts)
+            logger.info(f"Sinking {len(evts)} events")
+        except Exception as e:
+            logger.error(f"Could not store {len(evts)} events: {e}")
+            sink_backoff_until = time.monotonic() + EVENT_SINK_BACKOFF
+            await journal.append(evts)
+    if sink_stats.report_due(EVENT_SINK_REPORT_INTERVAL):
+        logger.info(
+            f"event_sink stats: {sink_stats.summary()}, "
+            f"queued: {len(equeue)}, dropped: {equeue.dropped}"
+        )
+
+
+@loop(5)
+async def replay_journal():
+    """Store spilled events, oldest segment first.
+
+    They keep their `created_at` and id, so /events pages that were read in
+    the meantime do not include them (see `get_events`).
+    """
+    if not journal:
+        await asyncio.sleep(1)
+        return
+    segment = await journal.oldest()
+    if segment is None:
+        return
+    path, evts = segment
+    async with in_transaction():
+        for i in range(0, len(evts), EVENT_BATCH_SIZE):
+            # the segment may have been stored already before a crash
+            await store_events(evts[i : i + EVENT_BATCH_SIZE], ignore_conflicts=True)
+    await journal.remove(path)
+    logger.info(f"Replayed {len(evts)} events from {path.name}")
+
+
+async def persist_tags(updated: list[TagState], created: list[Tag]) -> dict[str, int]:
+    """Write a batch of tag changes in one transaction.
+
+    Returns:
+        dict[str, int]: EPC -> id of the created tags.
+    """
+    ids: dict[str, int] = {}
+    async with in_transaction():
+        version = await tag_versions.next() if updated or created else 0
+        for tag in created:
+            tag.version = version
+        if updated:
+            await Tag.bulk_update(
+                [
+                    Tag(
+                        id=s.id,
+                        last_loc_seen_id=s.loc,
+                        last_active_at=s.last_active_at,
+                        status=s.status,
+                        RSSI=s.RSSI,
+                        version=version,
+                    )
+                    for s in updated
+                ],
+                fields=TAG_STATE_FIELDS,
+            )
+        if created:
+            # upsert, the EPC might have been added by someone else in the meantime
+            await Tag.bulk_create(
+                created, on_conflict=["epc"], update_fields=TAG_STATE_FIELDS
+            )
+            ids = dict(
+                await Tag.filter(epc__in=[t.epc for t in created]).values_list(
+                    "epc", "id"
+                )
+            )
+    if updated or created:
+        collection_versions.bump("tags")
+    return ids
+
+
+async def apply_reads(revents: list[ReadEvent]) -> list[TagEvent]:
+    await location_index.resolve(e.location for e in revents)
+    async with tag_index.lock:
+        return await _apply_reads(revents)
+
+
+async def _apply_reads(revents: list[ReadEvent]) -> list[TagEvent]:
+    now = datetime.now(timezone.utc)
+    for mac in {loc_mac(e.location) for e in revents}:
+        device_liveness.seen(mac, now.timestamp())
+    tevents: list[TagEvent] = []
+    updated: dict[str, TagState] = {}
+    changed: set[str] = set()  # EPCs that need more than a heartbeat
+    created: dict[str, Tag] = {}
+    for e in revents:
+        mloc = e.location if e.location in location_index else None
+        if not mloc:
+            logger.error(f"No object in db for location {(e.location)!r}!")
+
+        if ntag := created.get(e.epc):
+            # Tag read more than once in this batch
+            ntag.last_loc_seen_id = mloc
+            ntag.RSSI = e.RSSI
+            continue
+
+        state = updated.get(e.epc) or tag_index.get(e.epc)
+        if state:
+            # Tag exists in DB
+            if state.status == TagStatus.LOST:
+                tevents.append(
+                    TagEvent(
+                        type=EventType.TAG_REAPPEARED,
+                        tag_id=state.id,
+                        data={
+                            "from": state.loc,
+                            "gone_for": (now - state.last_active_at).total_seconds(),
+                        },
+                        epc=state.epc,
+                        loc=e.location,
+                    )
+                )
+                logger.debug(f"Tag {state.epc} reappeared")
+                changed.add(e.epc)
+            elif state.status != TagStatus.ACTIVE:
+                # its reader is back, no event as the tag never went missing
+                changed.add(e.epc)
+
+            if state.loc != e.location:
+                tevents.append(
+                    TagEvent(
+                        type=EventType.TAG_LOC_CHANGE,
+                        tag_id=state.id,
+                        data={
+                            "from": state.loc,
+                            "to": e.location,
+                        },
+                        epc=state.epc,
+                        loc=e.location,
+                    )
+                )
+                logger.debug(f"Tag {state.epc} moved")
+                changed.add(e.epc)
+            elif state.loc != mloc:
+                # same antenna, but its location got unregistered since the
+                # last read, so last_loc_seen has to become NULL
+                changed.add(e.epc)
+
+            # the index is only updated once the batch is in the DB
+            updated[e.epc] = replace(
+                state,
+                loc=mloc,
+                last_active_at=now,
+                status=TagStatus.ACTIVE,
+                RSSI=e.RSSI,
+            )
+        else:
+            # Tag doesnt exist in DB
+            logger.debug(f"Adding tag: {e.epc}")
+            created[e.epc] = Tag(
+                last_active_at=now,
+                status=TagStatus.ACTIVE,
+                epc=e.epc,
+                RSSI=e.RSSI,
+                last_loc_seen_id=mloc,
+                name=e.epc,
+                description="",
+            )
+
+    ids = await persist_tags([updated[epc] for epc in changed], list(created.values()))
+
+    for epc, state in updated.items():
+        tag_index.add(state)
+        if epc in changed:
+            tag_index.mark_clean(state)
+        else:
+            tag_index.mark_dirty(state)
+    for epc, ntag in created.items():
+        tag_index.add(
+            TagState(
+                ids[epc], epc, TagStatus.ACTIVE, ntag.last_loc_seen_id, now, ntag.RSSI
+            )
+        )
+        tevents.append(
+            TagEvent(
+                type=EventType.TAG_ADDED,
+                tag_id=ids[epc],
+                data={"to": ntag.last_loc_seen_id},
+                epc=epc,
+                loc=ntag.last_loc_seen_id,
+            )
+        )
+    return tevents
 
 
 @loop()
 async def process_kmqtt():
+    await tag_index.ensure_loaded()
+
     async with aiomqtt.Client(**KEONN_BROKER_CONF, identifier="processor") as kmqtt:
         await kmqtt.subscribe("RFID/devices")
 
@@ -100,79 +492,18 @@ async def process_kmqtt():
             f"process_kmqtt connected to broker at {KEONN_BROKER_CONF['hostname']}"
         )
 
-        async for revents in keonn_revents_stream(kmqtt.messages):
-            tags = (
-                await Tag.filter(epc__in=[e.epc for e in revents])
-                .prefetch_related("last_loc_seen")
-                .all()
-            )
-            locobjs = await Location.filter(loc__in=[e.location for e in revents]).all()
-
-            tevents = []
-            for e in revents:
-                dbtag, mloc = None, None
-                with suppress(StopIteration):
-                    dbtag = next(filter(lambda t: t.epc == e.epc, tags))
-                with suppress(StopIteration):
-                    mloc = next(filter(lambda lo: lo.loc == e.location, locobjs))
-
-                if not mloc:
-                    logger.error(f"No object in db for location {(e.location)!r}!")
-
-                if dbtag:
-                    tag_loc = dbtag.last_loc_seen and dbtag.last_loc_seen.loc
-                    # Tag exists in DB
-                    if dbtag.status == TagStatus.LOST:
-                        tevents.append(
-                            TagEvent(
-                                type=EventType.TAG_REAPPEARED,
-                                tag=dbtag,
-                                data={
-                                    "from": tag_loc,
-                                    "gone_for": (
-                                        datetime.now(timezone.utc)
-                                        - dbtag.last_active_at
-                                    ).total_seconds(),
-                                },
-                            )
-                        )
-                        logger.debug(f"Tag {dbtag.epc} reappeared")
-
-                    if tag_loc != e.location:
-                        tevents.append(
-                            TagEvent(
-                                type=EventType.TAG_LOC_CHANGE,
-                                tag=dbtag,
-                                data={
-                                    "from": tag_loc,
-                                    "to": e.location,
-                                },
-                            )
-                        )
-                        logger.debug(f"Tag {dbtag.epc} moved")
-
-                    dbtag.last_loc_seen = mloc
-                    dbtag.last_active_at = datetime.now(timezone.utc)
-                    dbtag.status = TagStatus.ACTIVE
-                    await dbtag.save()
-                else:
-                    # Tag doesnt exist in DB
-                    logger.debug(f"Adding tag: {e.epc}")
-                    ntag = await Tag.create(
-                        last_active_at=datetime.now(timezone.utc),
-                        status=TagStatus.ACTIVE,
-                        epc=e.epc,
-                        RSSI=e.RSSI,
-                        last_loc_seen=mloc,
-                        name=e.epc,
-                        description="",
-                    )
-                    tevents.append(
-                        TagEvent(type=EventType.TAG_ADDED, tag=ntag, data={})
-                    )
-            if tevents:
-                logger.debug(f"Adding {len(tevents)} events")
-                await equeue.put(tevents)
+        batches = coalesce_revents(
+            keonn_revents_stream(kmqtt.messages),
+            INGEST_BATCH_WINDOW,
+            INGEST_BATCH_MAX_READS,
+        )
+        # stops the pump as soon as the client goes away
+        async with aclosing(batches):
+            async for revents in batches:
+                tevents = await apply_reads(revents)
+                if tevents:
+                    logger.debug(f"Adding {len(tevents)} events")
+                    await equeue.put(tevents)
 
 
 @loop()
@@ -193,6 +524,7 @@ async def process_status():
             if dev is None:
                 logger.error(f"process_status: unknown device {mac=}")
                 continue
+            listed = (dev.online, dev.ip, dev.name)
             if dev.ip != ip:
                 logger.debug(f"New IP for device {dev.id}: {ip}")
                 try:
@@ -201,7 +533,11 @@ async def process_status():
                     await update_ip(dev.id, ip)
                 except Exception as e:
                     logger.exception(e)
+            device_liveness.seen(mac)
             dev.online = True
             dev.last_active_at = datetime.now(timezone.utc)
             await dev.save()
+            # a ping alone does not invalidate the cached /devices lists
+            if (dev.online, dev.ip, dev.name) != listed:
+                collection_versions.bump("devices")
             logger.debug(f"Device {dev.id} updated!")
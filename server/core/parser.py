@@ -1,13 +1,16 @@
-import re
-from collections.abc import AsyncGenerator
+import asyncio
+import sys
+from collections.abc import AsyncGenerator, AsyncIterator
 from dataclasses import dataclass
+from functools import lru_cache
 
 from aiomqtt.client import Client
-from ..logging import get_configured_logger
-# sample message content "60:e8:5b:0a:78:5f|e28011700000020f7cbd7358:-39@1/0/0|e28011700000020f7cbd73a7:-39@1/0/0|00000000deadbeef:-31@1/0/0|e28011700000020f7cbd7348:-41@1/0/0|e28011700000020f7cbd73c7:-46@1/0/0"
+from server.logging import get_configured_logger
 
+SAMPLE_MESSAGE = b"60:e8:5b:0a:78:5f|e28011700000020f7cbd7358:-39@1/0/0|e28011700000020f7cbd73a7:-39@1/0/0|00000000deadbeef:-31@1/0/0|e28011700000020f7cbd7348:-41@1/0/0|e28011700000020f7cbd73c7:-46@1/0/0"
 
-@dataclass
+
+@dataclass(slots=True)
 class ReadEvent:
     epc: str
     RSSI: int
@@ -17,17 +20,154 @@ class ReadEvent:
 logger = get_configured_logger(__name__)
 
 
+@lru_cache(maxsize=4096)
+def _location(mac: bytes, antenna: bytes) -> str:
+    # there are only a handful of antennas per reader, so every read of the
+    # same antenna shares one string
+    return sys.intern(f"{mac.decode()}/{antenna.decode()}")
+
+
+def parse_keonn_payload(payload: bytes) -> list[ReadEvent]:
+    """Parse a `RFID/devices` payload: `mac|epc:rssi@ant/mux1/mux2|...`"""
+    mac, *tags = payload.split(b"|")
+    revents: list[ReadEvent] = []
+    for tag in tags:
+        epc, _, rest = tag.partition(b":")
+        rssi, sep, antenna = rest.partition(b"@")
+        if not sep:
+            raise ValueError(f"Malformed tag read {tag!r}")
+        revents.append(ReadEvent(epc.decode(), int(rssi), _location(mac, antenna)))
+    return revents
+
+
 async def keonn_revents_stream(
     mesidz_stream: Client.MessagesIterator,
 ) -> AsyncGenerator[list[ReadEvent], None]:
     async for message in mesidz_stream:
         try:
-            message = message.payload.decode()
-            mac, *tags = message.split("|")
-            revents: list[ReadEvent] = []
-            for tag in tags:
-                epc, rssi, location = re.split(":|@", tag)
-                revents.append(ReadEvent(epc, int(rssi), f"{mac}/{location}"))
-            yield revents
+            payload = message.payload
+            if isinstance(payload, str):
+                payload = payload.encode()
+            yield parse_keonn_payload(payload)
         except Exception as e:
             logger.error(str(e))
+
+
+async def coalesce_revents(
+    revents_stream: AsyncIterator[list[ReadEvent]],
+    window: float,
+    max_reads: int,
+) -> AsyncGenerator[list[ReadEvent], None]:
+    """Merge the reads of many messages into one batch.
+
+    A batch is closed `window` seconds after its first message arrived or
+    once it holds `max_reads` reads, whichever comes first. Only the newest
+    read of every EPC is kept. While `max_reads` reads are waiting, the
+    source is not read any further.
+
+    The source is read by a background task, close the generator (e.g. with
+    `contextlib.aclosing`) to stop it.
+    """
+    queue: asyncio.Queue[list[ReadEvent]] = asyncio.Queue()
+    queued = 0  # reads in queue
+    room = asyncio.Condition()
+
+    async def pump():
+        nonlocal queued
+        async for revents in revents_stream:
+            async with room:
+                await room.wait_for(lambda: queued < max_reads)
+                queued += len(revents)
+            queue.put_nowait(revents)
+
+    pump_task = asyncio.create_task(pump())
+    aloop = asyncio.get_running_loop()
+
+    async def next_revents(timeout: float | None) -> list[ReadEvent] | None:
+        get = asyncio.ensure_future(queue.get())
+        await asyncio.wait(
+            (get, pump_task), timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if get.done():
+            nonlocal queued
+            revents = get.result()
+            async with room:
+                queued -= len(revents)
+                room.notify()
+            return revents
+        get.cancel()
+        if pump_task.done():
+            # re-raise whatever stopped the source (e.g. MQTT disconnect)
+            pump_task.result()
+            raise StopAsyncIteration
+        return None
+
+    try:
+        while True:
+            try:
+                revents = await next_revents(None)
+            except StopAsyncIteration:
+                return
+            deadline = aloop.time() + window
+            batch: dict[str, ReadEvent] = {}
+            nreads = 0
+            error: BaseException | None = None
+            while revents is not None:
+                for e in revents:
+                    batch.pop(e.epc, None)
+                    batch[e.epc] = e
+                nreads += len(revents)
+                timeout = deadline - aloop.time()
+                if nreads >= max_reads or timeout <= 0:
+                    break
+                try:
+                    revents = await next_revents(timeout)
+                except Exception as e:
+                    # hand out what we already have before failing
+                    error = e
+                    break
+            if nreads > len(batch):
+                logger.debug(f"Coalesced {nreads} reads into {len(batch)}")
+            yield list(batch.values())
+            if isinstance(error, StopAsyncIteration):
+                return
+            if error is not None:
+                raise error
+    finally:
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    import re
+    import timeit
+
+    @dataclass
+    class LegacyReadEvent:
+        epc: str
+        RSSI: int
+        location: str
+
+    def legacy_parse(payload: bytes) -> list[LegacyReadEvent]:
+        mac, *tags = payload.decode().split("|")
+        revents = []
+        for tag in tags:
+            epc, rssi, location = re.split(":|@", tag)
+            revents.append(LegacyReadEvent(epc, int(rssi), f"{mac}/{location}"))
+        return revents
+
+    mac, _, tags = SAMPLE_MESSAGE.partition(b"|")
+    big_message = mac + b"|" + b"|".join([tags] * 40)  # 200 reads
+
+    assert [(e.epc, e.RSSI, e.location) for e in parse_keonn_payload(big_message)] == [
+        (e.epc, e.RSSI, e.location) for e in legacy_parse(big_message)
+    ]
+
+    for name, msg in (("5 reads", SAMPLE_MESSAGE), ("200 reads", big_message)):
+        n = 20_000 if msg is SAMPLE_MESSAGE else 1_000
+        t_old = min(timeit.repeat(lambda: legacy_parse(msg), number=n, repeat=5))
+        t_new = min(timeit.repeat(lambda: parse_keonn_payload(msg), number=n, repeat=5))
+        print(
+            f"{name:>9}: legacy {t_old / n * 1e6:7.2f} us/msg, "
+            f"bytes {t_new / n * 1e6:7.2f} us/msg ({t_old / t_new:.1f}x)"
+        )
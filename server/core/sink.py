@@ -0,0 +1,129 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from typing import Literal, get_args
+
+from server.core.journal import EventJournal
+from server.logging import get_configured_logger
+from server.models import Event, TagEvent
+
+logger = get_configured_logger(__name__, "DEBUG")
+
+seconds = float
+
+QueuePolicy = Literal["block", "drop_oldest"]
+
+
+class EventQueue:
+    """Bounded FIFO of `TagEvent`s between the producers and `event_sink`.
+
+    When `maxsize` events are waiting, `put` either blocks the producer until
+    the sink catches up (`block`) or drops the oldest events (`drop_oldest`).
+    """
+
+    def __init__(self, maxsize: int, policy: QueuePolicy = "block") -> None:
+        if policy not in get_args(QueuePolicy):
+            raise ValueError(
+                f"Unknown event queue policy {policy!r}, "
+                f"expected one of {get_args(QueuePolicy)}"
+            )
+        self.__events: deque[TagEvent] = deque()
+        self.__changed = asyncio.Condition()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+
+    async def put(self, events: list[TagEvent]) -> None:
+        async with self.__changed:
+            if self.policy == "block":
+                await self.__changed.wait_for(lambda: len(self.__events) < self.maxsize)
+            self.__events.extend(events)
+            overflow = len(self.__events) - self.maxsize
+            if self.policy == "drop_oldest" and overflow > 0:
+                for _ in range(overflow):
+                    self.__events.popleft()
+                self.dropped += overflow
+                logger.warning(f"Event queue full, dropped {overflow} oldest events")
+            self.__changed.notify_all()
+
+    async def get_batch(self, max_items: int, linger: seconds) -> list[TagEvent]:
+        """Wait for events, then up to `linger` seconds for `max_items` of them."""
+        async with self.__changed:
+            await self.__changed.wait_for(lambda: self.__events)
+            if len(self.__events) < max_items:
+                try:
+                    await asyncio.wait_for(
+                        self.__changed.wait_for(
+                            lambda: len(self.__events) >= max_items
+                        ),
+                        linger,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            n = min(max_items, len(self.__events))
+            batch = [self.__events.popleft() for _ in range(n)]
+            self.__changed.notify_all()
+            return batch
+
+    def __len__(self) -> int:
+        return len(self.__events)
+
+
+class SinkStats:
+    """Rolling window of flushed batch sizes and their write latencies."""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.sizes: deque[int] = deque(maxlen=window)
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.last_report = time.monotonic()
+
+    def record(self, size: int, latency: seconds) -> None:
+        self.sizes.append(size)
+        self.latencies.append(latency)
+
+    @staticmethod
+    def _distribution(values: deque) -> dict[str, float]:
+        if len(values) < 2:
+            v = values[0] if values else 0
+            return {"p50": v, "p95": v, "max": v}
+        q = statistics.quantiles(values, n=20, method="inclusive")
+        return {"p50": q[9], "p95": q[18], "max": max(values)}
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        return {
+            "batch_size": self._distribution(self.sizes),
+            "latency_ms": {
+                k: v * 1000 for k, v in self._distribution(self.latencies).items()
+            },
+        }
+
+    def report_due(self, interval: seconds) -> bool:
+        now = time.monotonic()
+        if now - self.last_report < interval:
+            return False
+        self.last_report = now
+        return True
+
+
+class EventIds:
+    """Hands out `Event.id`s before the insert, so live events carry their cursor.
+
+    Assumes this process is the only one inserting events.
+    """
+
+    def __init__(self) -> None:
+        self.__next: int | None = None
+
+    async def ensure_loaded(self, journal: EventJournal) -> None:
+        if self.__next is not None:
+            return
+        db_max = await Event.all().order_by("-id").first().values_list("id", flat=True)
+        self.__next = max(db_max or 0, await journal.max_id()) + 1
+        logger.debug(f"Next event id: {self.__next}")
+
+    def assign(self, events: list[TagEvent]) -> None:
+        assert self.__next is not None, "ensure_loaded first"
+        for e in events:
+            e.id = self.__next
+            self.__next += 1
@@ -0,0 +1,331 @@
+import asyncio
+import heapq
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from datetime import datetime
+
+from tortoise.expressions import F
+
+from server.core import DEVICE_OFFLINE_AFTER, LOST_THRESHOLD
+from server.logging import get_configured_logger
+from server.models import Counter, Device, Location, Tag, TagStatus
+
+logger = get_configured_logger(__name__, "DEBUG")
+
+seconds = float
+
+
+@dataclass(slots=True)
+class TagState:
+    id: int
+    epc: str
+    status: TagStatus
+    loc: str | None  # Location.loc, same as Tag.last_loc_seen_id
+    last_active_at: datetime
+    RSSI: int
+
+
+class DeadlineQueue:
+    """Min-heap of `(deadline, id)` with at most one live entry per id.
+
+    Scheduling an id again only pushes when the new deadline is earlier,
+    superseded entries are skipped when they surface.
+    """
+
+    def __init__(self) -> None:
+        self.__heap: list[tuple[float, int]] = []
+        self.__deadlines: dict[int, float] = {}
+
+    def schedule(self, id: int, deadline: float) -> None:
+        current = self.__deadlines.get(id)
+        if current is not None and current <= deadline:
+            return
+        self.__deadlines[id] = deadline
+        heapq.heappush(self.__heap, (deadline, id))
+
+    def discard(self, id: int) -> None:
+        self.__deadlines.pop(id, None)
+
+    def pop_expired(self, now: float) -> list[int]:
+        expired = []
+        while self.__heap and self.__heap[0][0] <= now:
+            deadline, id = heapq.heappop(self.__heap)
+            if self.__deadlines.get(id) == deadline:
+                del self.__deadlines[id]
+                expired.append(id)
+        return expired
+
+    def next_deadline(self) -> float | None:
+        while self.__heap:
+            deadline, id = self.__heap[0]
+            if self.__deadlines.get(id) == deadline:
+                return deadline
+            heapq.heappop(self.__heap)
+        return None
+
+    def __len__(self) -> int:
+        return len(self.__deadlines)
+
+
+class TagIndex:
+    """Resident EPC -> TagState map, kept authoritative by the ingest path.
+
+    The database is only read once in `load`, afterwards every writer of
+    tag state in this process has to update the index as well, holding `lock`.
+    Tags whose `last_active_at`/`RSSI` are newer in memory than in the database
+    are tracked as dirty until they get flushed. Every active tag is scheduled
+    in `deadlines` to be considered lost `threshold(state)` seconds after its
+    last read.
+    """
+
+    def __init__(self, threshold: Callable[[TagState], seconds]) -> None:
+        self.__tags: dict[str, TagState] = {}
+        self.__by_id: dict[int, TagState] = {}
+        self.__dirty: set[int] = set()
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        self.threshold = threshold
+        self.deadlines = DeadlineQueue()
+
+    async def ensure_loaded(self) -> None:
+        async with self.lock:
+            if not self.loaded:
+                await self.load()
+
+    async def load(self) -> None:
+        rows = await Tag.all().values_list(
+            "id",
+            "epc",
+            "status",
+            "last_loc_seen_id",
+            "last_active_at",
+            "RSSI",
+        )
+        self.__tags.clear()
+        self.__by_id.clear()
+        self.__dirty.clear()
+        self.deadlines = DeadlineQueue()
+        for id, epc, status, loc, last_active_at, rssi in rows:
+            self.add(TagState(id, epc, TagStatus(status), loc, last_active_at, rssi))
+        self.loaded = True
+        logger.info(f"Loaded {len(self.__tags)} tags into the index")
+
+    def add(self, state: TagState) -> None:
+        self.__tags[state.epc] = state
+        self.__by_id[state.id] = state
+        self.schedule(state)
+
+    def lost_deadline(self, state: TagState) -> float:
+        return state.last_active_at.timestamp() + self.threshold(state)
+
+    def schedule(self, state: TagState) -> None:
+        if state.status == TagStatus.ACTIVE:
+            self.deadlines.schedule(state.id, self.lost_deadline(state))
+
+    def reschedule_all(self) -> None:
+        """Pick up lowered thresholds, raised ones are handled on expiry."""
+        for state in self.__tags.values():
+            self.schedule(state)
+
+    def clear_locations(self, locs: set[str]) -> None:
+        """Forget `locs` as the last location of the tags seen there."""
+        for state in self.__tags.values():
+            if state.loc in locs:
+                state.loc = None
+
+    def mark_dirty(self, state: TagState) -> None:
+        self.__dirty.add(state.id)
+
+    def mark_clean(self, state: TagState) -> None:
+        self.__dirty.discard(state.id)
+
+    def pop_dirty(self) -> list[TagState]:
+        dirty = [self.__by_id[id] for id in self.__dirty if id in self.__by_id]
+        self.__dirty.clear()
+        return dirty
+
+    def get(self, epc: str) -> TagState | None:
+        return self.__tags.get(epc)
+
+    def by_id(self, id: int) -> TagState | None:
+        return self.__by_id.get(id)
+
+    def __len__(self) -> int:
+        return len(self.__tags)
+
+    def __iter__(self) -> Iterator[TagState]:
+        return iter(self.__tags.values())
+
+
+class TagVersions:
+    """`Tag.version`s for delta syncs, allocated from a `Counter` row.
+
+    `next` has to be awaited inside the transaction that writes the version,
+    the row stays locked until it commits, so versions commit in order in
+    every process sharing the database.
+    """
+
+    counter = "tag_version"
+
+    def __init__(self) -> None:
+        self.ready = False
+
+    async def ensure(self) -> None:
+        if self.ready:
+            return
+        latest = (
+            await Tag.all()
+            .order_by("-version")
+            .first()
+            .values_list("version", flat=True)
+        )
+        await Counter.get_or_create(name=self.counter, defaults={"value": latest or 0})
+        self.ready = True
+
+    async def next(self) -> int:
+        await self.ensure()
+        await Counter.filter(name=self.counter).update(value=F("value") + 1)
+        return (
+            await Counter.filter(name=self.counter)
+            .first()
+            .values_list("value", flat=True)
+        )
+
+
+class LocationIndex:
+    """`Location.loc` keys known to the database with their lost thresholds.
+
+    The whole (small) table is cached and reloaded after `invalidate`, `version`
+    is bumped on every reload. Misses are looked up again at most every
+    `retry_after` seconds, so a reader with unregistered antennas does not
+    cause a query per message.
+    """
+
+    def __init__(self, retry_after: seconds = 30) -> None:
+        # loc -> location threshold or its device threshold
+        self.__locs: dict[str, seconds | None] = {}
+        self.__missing: dict[str, float] = {}
+        self.retry_after = retry_after
+        self.stale = True
+        self.version = 0
+
+    async def load(self) -> None:
+        rows = await Location.all().values_list(
+            "loc", "lost_threshold", "device__lost_threshold"
+        )
+        self.__locs = {loc: lt if lt is not None else dlt for loc, lt, dlt in rows}
+        self.__missing.clear()
+        self.stale = False
+        self.version += 1
+
+    async def resolve(self, locs: Iterable[str]) -> None:
+        if self.stale:
+            await self.load()
+        now = time.monotonic()
+        unknown = {
+            loc
+            for loc in locs
+            if loc not in self.__locs
+            and now - self.__missing.get(loc, -self.retry_after) >= self.retry_after
+        }
+        if not unknown:
+            return
+        rows = await Location.filter(loc__in=unknown).values_list(
+            "loc", "lost_threshold", "device__lost_threshold"
+        )
+        for loc, lt, dlt in rows:
+            self.__locs[loc] = lt if lt is not None else dlt
+            self.__missing.pop(loc, None)
+        for loc in unknown - self.__locs.keys():
+            self.__missing[loc] = now
+
+    def invalidate(self) -> None:
+        """Reload the locations on the next `resolve`."""
+        self.stale = True
+
+    def threshold(self, loc: str | None) -> seconds:
+        lt = self.__locs.get(loc) if loc is not None else None
+        return LOST_THRESHOLD if lt is None else lt
+
+    def __contains__(self, loc: str) -> bool:
+        return loc in self.__locs
+
+
+class DeviceLiveness:
+    """When each reader (by MAC) was last heard from, by status ping or reads.
+
+    A reader silent for more than `offline_after` seconds is considered offline.
+    """
+
+    def __init__(self, offline_after: seconds) -> None:
+        self.__last_seen: dict[str, float] = {}
+        self.__returned: set[str] = set()
+        self.__started = time.time()
+        self.offline: set[str] = set()
+        self.offline_after = offline_after
+        self.loaded = False
+
+    async def load(self) -> None:
+        rows = await Device.all().values_list("mac", "online", "last_active_at")
+        for mac, online, last_active_at in rows:
+            if mac in self.__last_seen:
+                continue
+            self.__last_seen[mac] = last_active_at.timestamp()
+            if not online:
+                self.offline.add(mac)
+        self.loaded = True
+
+    def seen(self, mac: str, at: float | None = None) -> None:
+        self.__last_seen[mac] = time.time() if at is None else at
+        if mac in self.offline:
+            self.offline.discard(mac)
+            self.__returned.add(mac)
+
+    def last_seen(self, mac: str) -> float:
+        return self.__last_seen.get(mac, self.__started)
+
+    def mark_offline(self, mac: str) -> bool:
+        """Returns True if the reader was not known to be offline yet."""
+        if mac in self.offline:
+            return False
+        self.offline.add(mac)
+        self.__returned.discard(mac)
+        return True
+
+    def pop_returned(self) -> set[str]:
+        returned, self.__returned = self.__returned, set()
+        return returned
+
+
+class CollectionVersions:
+    """Change counters of the API collections (`tags`, `locations`, `devices`).
+
+    Every writer of a collection in this process has to `bump` it after the
+    commit. `epoch` keeps versions from before a restart from matching.
+    The counters only see this process's writes, so `tracking` is switched
+    off when another process (mqtt_db.py) ingests into the same database.
+    """
+
+    def __init__(self) -> None:
+        self.__versions: dict[str, int] = {}
+        self.epoch = f"{time.time_ns():x}"
+        self.tracking = True
+
+    def bump(self, *collections: str) -> None:
+        for collection in collections:
+            self.__versions[collection] = self.__versions.get(collection, 0) + 1
+
+    def __getitem__(self, collection: str) -> int:
+        return self.__versions.get(collection, 0)
+
+
+def loc_mac(loc: str) -> str:
+    return loc.partition("/")[0]
+
+
+location_index = LocationIndex()
+device_liveness = DeviceLiveness(offline_after=DEVICE_OFFLINE_AFTER)
+tag_index = TagIndex(threshold=lambda state: location_index.threshold(state.loc))
+tag_versions = TagVersions()
+collection_versions = CollectionVersions()
@@ -1,7 +1,9 @@
 from server.models.models import (
+    Counter,
     Device,
     Event,
     EventType,
+    LiveEvent,
     Location,
     MQTT_Message,
     Tag,
@@ -1,5 +1,6 @@
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from enum import IntEnum
 from typing import Any
 
@@ -12,6 +13,7 @@ from tortoise.validators import RegexValidator
 class TagStatus(IntEnum):
     ACTIVE = 0
     LOST = 1
+    READER_OFFLINE = 2
 
 
 class EventType(IntEnum):
@@ -19,6 +21,8 @@ class EventType(IntEnum):
     TAG_LOC_CHANGE = 1
     TAG_ADDED = 2
     TAG_REAPPEARED = 3
+    READER_OFFLINE = 4
+    READER_ONLINE = 5
 
 
 class TimestampMixin:
@@ -34,6 +38,17 @@ class MQTT_Message(BaseModel):
     event_id: int
 
 
+class LiveEvent(BaseModel):
+    """An event as pushed to /ws/mqtt clients, in JSON arrays of these."""
+
+    id: int
+    type: EventType
+    tag_id: int | None
+    epc: str | None
+    data: dict[str, Any]
+    created_at: datetime
+
+
 class device_metadata(BaseModel):
     id: str
     family: str
@@ -51,6 +66,8 @@ class Device(TimestampMixin, Model):
     ip = fields.CharField(max_length=255)
     online = fields.BooleanField(index=True)
     meta = fields.JSONField(field_type=device_metadata)
+    # seconds without a read before a tag is LOST, overridable per location
+    lost_threshold = fields.FloatField(null=True)
     locations: fields.ReverseRelation["Location"]
 
 
@@ -67,6 +84,7 @@ class Location(TimestampMixin, Model):
     device: fields.ForeignKeyRelation[Device] = fields.ForeignKeyField(
         "models.Device", related_name="locations"
     )
+    lost_threshold = fields.FloatField(null=True)
     tags: fields.ReverseRelation["Tag"]
 
     def __repr__(self):
@@ -82,12 +100,18 @@ class Tag(TimestampMixin, Model):
     epc = fields.CharField(max_length=255, index=True, unique=True)
     status: TagStatus = fields.IntEnumField(TagStatus, index=True)
     last_loc_seen: fields.ForeignKeyNullableRelation[Location] = fields.ForeignKeyField(
-        "models.Location", related_name="tags", null=True, to_field="loc"
+        "models.Location",
+        related_name="tags",
+        null=True,
+        to_field="loc",
+        on_delete=fields.SET_NULL,
     )
     events: fields.ReverseRelation["Event"]
     name = fields.CharField(max_length=255)
     description = fields.TextField()
     RSSI = fields.IntField()
+    # tag_versions.next() of the last status/location/name change
+    version = fields.BigIntField(default=0, index=True)
 
     def __repr__(self):
         return f"name: {self.name}, EPC: {self.epc}"
@@ -96,16 +120,39 @@ class Tag(TimestampMixin, Model):
 @dataclass
 class TagEvent:
     type: EventType
-    tag: Tag
+    tag_id: int | None  # None for reader events
     data: dict[Any, Any] | list[Any]
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    # used to route live events to websocket subscribers, epc is not stored
+    epc: str | None = None
+    loc: str | None = None
+    id: int | None = None  # assigned by event_sink before the insert
 
 
 class Event(Model):
     id = fields.IntField(pk=True)
-    tag: fields.ForeignKeyRelation[Tag] = fields.ForeignKeyField(
-        "models.Tag", related_name="events"
+    tag: fields.ForeignKeyNullableRelation[Tag] = fields.ForeignKeyField(
+        "models.Tag", related_name="events", null=True
     )
     type: EventType = fields.IntEnumField(EventType, index=True)
     notified = fields.BooleanField()
     data = fields.JSONField()
     created_at = fields.DatetimeField(auto_now_add=True)
+    # Location.loc the event happened at, not a FK as it may be unregistered
+    loc = fields.CharField(max_length=255, null=True)
+
+    class Meta:
+        # keyset pagination on (created_at, id), optionally within one filter
+        indexes = (
+            ("created_at", "id"),
+            ("tag_id", "created_at", "id"),
+            ("type", "created_at", "id"),
+            ("loc", "created_at", "id"),
+        )
+
+
+class Counter(Model):
+    """Named counter shared by every process using the database."""
+
+    name = fields.CharField(max_length=64, pk=True)
+    value = fields.BigIntField(default=0)
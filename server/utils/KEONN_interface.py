@@ -1,8 +1,11 @@
 import asyncio
+import functools
+import hashlib
 import ipaddress
 import json
 import pathlib as pl
 import re
+import time
 import xml.etree.ElementTree as ET
 from dataclasses import dataclass
 from typing import Any, Literal
@@ -10,7 +13,14 @@ from typing import Any, Literal
 import httpx
 from httpx import DigestAuth
 
-from server.core import KEONN_BROKER_CONF
+from server.core import (
+    KEONN_BROKER_CONF,
+    KEONN_CONNECT_TIMEOUT,
+    KEONN_DESCRIPTOR_TTL,
+    KEONN_KEEPALIVE_EXPIRY,
+    KEONN_MAX_CONNECTIONS,
+    KEONN_TIMEOUT,
+)
 from server.models import device_metadata
 
 
@@ -62,23 +72,107 @@ def get_mqtt_service_config(broker_config: str | None = None) -> dict[str, str]:
     return default_config
 
 
+@dataclass(frozen=True)
+class service_config:
+    fields: dict[str, str]
+    digest: str
+
+
+@functools.cache
+def mqtt_service_config() -> service_config:
+    """The default `get_mqtt_service_config()`, assembled once per process."""
+    fields = get_mqtt_service_config()
+    digest = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+    return service_config(fields, digest)
+
+
+@functools.cache
+def read_mode_config() -> dict[str, str]:
+    return cfg_to_dict(CONFIG_DIR / "readmode.json")
+
+
+def config_diff(wanted: dict[str, str], current: ET.Element) -> list[str]:
+    """Keys of `wanted` whose value in the device's `current` config differs."""
+    diff = []
+    for key, value in wanted.items():
+        el = current.find(f".//{key}")
+        if el is None:
+            diff.append(key)
+            continue
+        have = el.text or ""
+        if key == "config":
+            # the reader may reformat the JSON it was given
+            try:
+                same = json.loads(have) == json.loads(value)
+            except ValueError:
+                same = False
+        else:
+            same = have == value
+        if not same:
+            diff.append(key)
+    return diff
+
+
+IP = ipaddress.IPv4Address | ipaddress.IPv6Address
+
+
+class KeonnSessions:
+    """One keep-alive `httpx.AsyncClient` per reader.
+
+    Each client has its own `DigestAuth`, which keeps the reader's last
+    challenge and answers it up front instead of waiting for a 401.
+    """
+
+    def __init__(self) -> None:
+        self.__clients: dict[IP, httpx.AsyncClient] = {}
+        self.limits = httpx.Limits(
+            max_connections=KEONN_MAX_CONNECTIONS,
+            max_keepalive_connections=KEONN_MAX_CONNECTIONS,
+            keepalive_expiry=KEONN_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = httpx.Timeout(KEONN_TIMEOUT, connect=KEONN_CONNECT_TIMEOUT)
+
+    def get(self, ip: IP) -> httpx.AsyncClient:
+        client = self.__clients.get(ip)
+        if client is None or client.is_closed:
+            host = f"[{ip}]" if ip.version == 6 else str(ip)
+            client = self.__clients[ip] = httpx.AsyncClient(
+                base_url=f"http://{host}:3161",
+                auth=DigestAuth("admin", "admin"),
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return client
+
+    async def aclose(self) -> None:
+        clients, self.__clients = self.__clients, {}
+        await asyncio.gather(*(c.aclose() for c in clients.values()))
+
+
+sessions = KeonnSessions()
+
+
 class API:
-    __IP: ipaddress.IPv4Address | ipaddress.IPv6Address
-    auth = DigestAuth("admin", "admin")
+    __IP: IP
 
     def __init__(self, IP: str):
         self.__IP = ipaddress.ip_address(IP)
 
+    @property
+    def ip(self) -> IP:
+        return self.__IP
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return sessions.get(self.__IP)
+
     async def get(self, path: str, **kwargs):
         try:
-            async with httpx.AsyncClient() as client:
-                res = await client.get(
-                    url=f"http://{self.__IP}:3161{path}",
-                    auth=kwargs.pop("auth", self.auth),
-                    **kwargs,
-                )
-                res.raise_for_status()
-                return res
+            res = await self.client.get(
+                path, auth=kwargs.pop("auth", httpx.USE_CLIENT_DEFAULT), **kwargs
+            )
+            res.raise_for_status()
+            return res
         except httpx.RequestError as e:
             e.args = (f"{e.request.method} request to {e.request.url.host} failed!",)
             raise e
@@ -89,34 +183,91 @@ class API:
 
     async def put(self, path: str, data: Any, **kwargs):
         try:
-            async with httpx.AsyncClient() as client:
-                res = await client.put(
-                    url=f"http://{self.__IP}:3161{path}",
-                    data=data,
-                    auth=kwargs.pop("auth", self.auth),
-                    **kwargs,
-                )
-                res.raise_for_status()
-                return res
+            res = await self.client.put(
+                path,
+                content=data,
+                auth=kwargs.pop("auth", httpx.USE_CLIENT_DEFAULT),
+                **kwargs,
+            )
+            res.raise_for_status()
+            return res
         except httpx.RequestError as e:
             e.args = (f"{e.request.method} request to {e.request.url.host} failed!",)
             raise e
 
     async def put_xml(self, path: str, data: ET.Element, **kwargs):
-        kwargs["headers"] = kwargs.get("headers", {}).update(
-            {"Content-Type": "application/xml"}
-        )
+        kwargs["headers"] = {
+            **kwargs.get("headers", {}),
+            "Content-Type": "application/xml",
+        }
         res = await self.put(path, ET.tostring(data), **kwargs)
         return ET.fromstring(res.text)
 
 
+@dataclass
+class device_descriptor:
+    """What the readers' /devices tells about the (only) device."""
+
+    device_id: str
+    mac: str
+    active_read_mode: str
+    status: str
+    serial: str
+    code: str
+    fw_version: str
+    rf_module: str
+
+
+class DescriptorCache:
+    """`device_descriptor`s by reader IP, fetched at most once per `ttl`.
+
+    Helpers that change what /devices reports `invalidate` it.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.__entries: dict[IP, tuple[float, device_descriptor]] = {}
+        self.__locks: dict[IP, asyncio.Lock] = {}
+        self.ttl = ttl
+
+    async def get(self, device_api: API) -> device_descriptor:
+        ip = device_api.ip
+        # concurrent callers share one fetch
+        async with self.__locks.setdefault(ip, asyncio.Lock()):
+            entry = self.__entries.get(ip)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            root = await device_api.get_xml("/devices")
+            descriptor = device_descriptor(
+                device_id=root.find(".//device/id").text,
+                mac=root.find(".//device/mac").text,
+                active_read_mode=root.find(".//device/activeReadMode").text,
+                status=root.find(".//device/status").text,
+                serial=root.find(".//device/serial").text,
+                code=root.find(".//device/code").text,
+                fw_version=root.find(".//device/firmware/version").text
+                + "."
+                + root.find(".//device/firmware/revision").text,
+                rf_module=root.find(".//device/rf-module").text,
+            )
+            self.__entries[ip] = time.monotonic(), descriptor
+            return descriptor
+
+    def invalidate(self, device_api: API) -> None:
+        self.__entries.pop(device_api.ip, None)
+
+
+descriptors = DescriptorCache(KEONN_DESCRIPTOR_TTL)
+
+
 async def restart_device(device_api: API):
     await device_api.get("/system/runtime/reboot")
+    descriptors.invalidate(device_api)
 
 
 async def set_RF(device_api: API, state: bool):
-    device_id = (await get_info(device_api)).device_id
+    device_id = (await descriptors.get(device_api)).device_id
     await device_api.get(f"/devices/{device_id}/{'start' if state else 'stop'}")
+    descriptors.invalidate(device_api)
 
 
 def __def_to_location(def_: str, mac: str = "") -> tuple[str, str]:
@@ -128,50 +279,61 @@ def __def_to_location(def_: str, mac: str = "") -> tuple[str, str]:
 
 
 async def get_locations(device_api: API):
-    root = await device_api.get_xml("/devices")
-    device_id = root.find(".//device/id").text
-    mac = root.find(".//device/mac").text
-    loc_root = await device_api.get_xml(f"/devices/{device_id}/antennas")
+    descriptor = await descriptors.get(device_api)
+    loc_root = await device_api.get_xml(f"/devices/{descriptor.device_id}/antennas")
 
     return (
-        __def_to_location(d.text, mac)
+        __def_to_location(d.text, descriptor.mac)
         for d in loc_root.iterfind(".//data/entries/entry/def")
     )
 
 
-async def configure_keonn(device_api: API):
-    root = await device_api.get_xml("/devices")
-    device_id = root.find(".//device/id").text
-    active_read_mode = root.find(".//device/activeReadMode").text
-    if active_read_mode != "AUTONOMOUS":
+async def configure_keonn(device_api: API) -> list[str]:
+    """Bring the reader to our read mode and MQTT service config.
+
+    Only the sections that differ from what the reader has are pushed, and the
+    config is only saved to flash if any was. Returns the pushed sections.
+    """
+    descriptor = await descriptors.get(device_api)
+    device_id = descriptor.device_id
+    pushed = []
+    if descriptor.active_read_mode != "AUTONOMOUS":
+        descriptors.invalidate(device_api)
         await device_api.put(
             f"/devices/{device_id}/activeDeviceMode", data="Autonomous"
         )
         await device_api.put(f"/devices/{device_id}/activeReadMode", data="AUTONOMOUS")
-        mode_conf = cfg_to_dict(CONFIG_DIR / "readmode.json")
-        req = xml_request_from_dict(mode_conf)
+        req = xml_request_from_dict(read_mode_config())
         await device_api.put_xml(f"/devices/{device_id}/readMode", req)
-
-    mqtt_conf = get_mqtt_service_config()
-    mqtt_conf["clientId"] = device_id
-    req = xml_request_from_dict(mqtt_conf)
-    await asyncio.sleep(0.3)
-    await device_api.put_xml("/system/services/byId/MQTTService", req)
-    await device_api.get(f"/devices/{device_id}/confSave")
-    await device_api.get("/conf/save")
+        pushed.append("readMode")
+        await asyncio.sleep(0.3)
+
+    mqtt_conf = {**mqtt_service_config().fields, "clientId": device_id}
+    try:
+        current = await device_api.get_xml("/system/services/byId/MQTTService")
+        changed = config_diff(mqtt_conf, current)
+    except (httpx.HTTPStatusError, ET.ParseError):
+        changed = list(mqtt_conf)
+    if changed:
+        req = xml_request_from_dict(mqtt_conf)
+        await device_api.put_xml("/system/services/byId/MQTTService", req)
+        pushed.append("MQTTService")
+
+    if pushed:
+        await device_api.get(f"/devices/{device_id}/confSave")
+        await device_api.get("/conf/save")
+    return pushed
 
 
 async def get_metadata(device_api: API) -> device_metadata:
-    root = await device_api.get_xml("/devices")
+    descriptor = await descriptors.get(device_api)
     return device_metadata(
-        id=root.find(".//device/id").text,
-        family=root.find(".//device/id").text,
-        serial=root.find(".//device/serial").text,
-        code=root.find(".//device/code").text,
-        fw_version=root.find(".//device/firmware/version").text
-        + "."
-        + root.find(".//device/firmware/revision").text,
-        rf_module=root.find(".//device/rf-module").text,
+        id=descriptor.device_id,
+        family=descriptor.device_id,
+        serial=descriptor.serial,
+        code=descriptor.code,
+        fw_version=descriptor.fw_version,
+        rf_module=descriptor.rf_module,
     )
 
 
@@ -184,12 +346,12 @@ class device_info:
 
 
 async def get_info(device_api: API) -> device_info:
-    root = await device_api.get_xml("/devices")
+    descriptor = await descriptors.get(device_api)
     return device_info(
-        root.find(".//device/id").text,
-        root.find(".//device/activeReadMode").text,
-        root.find(".//device/status").text,
-        root.find(".//device/mac").text,
+        descriptor.device_id,
+        descriptor.active_read_mode,
+        descriptor.status,
+        descriptor.mac,
     )
 
 
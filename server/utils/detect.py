@@ -3,12 +3,17 @@ import os
 import re
 import sys
 import time
+from collections.abc import Awaitable, Callable
 from copy import deepcopy
 from typing import TypedDict
 
-from zeroconf import IPVersion
+from zeroconf import IPVersion, ServiceStateChange, Zeroconf
 from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
 
+from server.logging import get_configured_logger
+
+logger = get_configured_logger(__name__, "DEBUG")
+
 
 class DeviceInfo(TypedDict):
     name: str
@@ -19,56 +24,101 @@ type MAC = str
 
 
 class KeonnFinder:
+    """Browses mDNS for readers for as long as it runs.
+
+    Keeps a MAC -> `DeviceInfo` registry up to date from the browser's
+    add/update/remove callbacks, `on_change` is awaited with every new or
+    changed entry.
+    """
+
     TYPE_ = "_workstation._tcp.local."
-    __devices = {}
+    NAME = re.compile(r"(?P<name>.*) \[(?P<mac>.*)\].*")
+    RESOLVE_TIMEOUT = 3000  # ms
 
-    def __init__(self) -> None:
+    def __init__(
+        self, on_change: Callable[[MAC, DeviceInfo], Awaitable[None]] | None = None
+    ) -> None:
         self.aiobrowser: AsyncServiceBrowser | None = None
         self.aiozc: AsyncZeroconf | None = None
-
-    async def run_detection(self) -> None:
-        """Run the detection to update the devices.
-
-        Returns:
-            dict[MAC, DeviceInfo]: MAC address as key for the device info dict.
-        """
-        self.aiozc = AsyncZeroconf(unicast=True, ip_version=IPVersion.V4Only)
-        await self.aiozc.zeroconf.async_wait_for_start()
-
-        def on_service_state_change(*args, **kwargs) -> None:
-            """Dummy handler."""
-
-        self.aiobrowser = AsyncServiceBrowser(
-            self.aiozc.zeroconf,
-            self.TYPE_,
-            handlers=[on_service_state_change],
-            delay=200,
-        )
-        await asyncio.sleep(0.5)
-        infos: list[AsyncServiceInfo] = []
-        for name in self.aiozc.zeroconf.cache.names():
-            if not name.endswith(f".{self.TYPE_}"):
-                continue
-            infos.append(AsyncServiceInfo(self.TYPE_, name))
-        tasks = [info.async_request(self.aiozc.zeroconf, 1000) for info in infos]
-        await asyncio.gather(*tasks)
-
-        new_devices: dict[MAC, DeviceInfo] = {}
-        for info in filter(None, infos):
-            parsed = re.compile("(?P<name>.*) \\[(?P<mac>.*)\\].*").match(info.name)
-            new_devices[parsed["mac"]] = {
-                "name": parsed["name"],
-                "ip": info.parsed_addresses()[0],
-            }
-        self.__devices = new_devices
-        await self.async_close()
-        return new_devices
+        self.on_change = on_change
+        self.__devices: dict[MAC, DeviceInfo] = {}
+        self.__names: dict[str, MAC] = {}  # service name -> MAC, for removals
+        self.__tasks: set[asyncio.Task] = set()
+
+    @property
+    def running(self) -> bool:
+        return self.aiobrowser is not None
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        try:
+            self.aiozc = AsyncZeroconf(ip_version=IPVersion.V4Only)
+            await self.aiozc.zeroconf.async_wait_for_start()
+            self.aiobrowser = AsyncServiceBrowser(
+                self.aiozc.zeroconf,
+                self.TYPE_,
+                handlers=[self._on_service_state_change],
+                delay=200,
+            )
+        except BaseException:
+            await self.async_close()
+            raise
+        logger.info("Browsing for readers")
+
+    def _on_service_state_change(
+        self,
+        zeroconf: Zeroconf,
+        service_type: str,
+        name: str,
+        state_change: ServiceStateChange,
+    ) -> None:
+        if state_change is ServiceStateChange.Removed:
+            mac = self.__names.pop(name, None)
+            if mac is not None:
+                logger.debug(f"Reader {mac} left")
+                self.__devices.pop(mac, None)
+            return
+        task = asyncio.create_task(self._resolve(name))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def _resolve(self, name: str) -> None:
+        parsed = self.NAME.match(name)
+        if parsed is None or self.aiozc is None:
+            return
+        info = AsyncServiceInfo(self.TYPE_, name)
+        if not await info.async_request(self.aiozc.zeroconf, self.RESOLVE_TIMEOUT):
+            logger.warning(f"Could not resolve {name!r}")
+            return
+        addresses = info.parsed_addresses()
+        if not addresses:
+            return
+        mac = parsed["mac"]
+        device: DeviceInfo = {"name": parsed["name"], "ip": addresses[0]}
+        self.__names[name] = mac
+        if self.__devices.get(mac) == device:
+            return
+        self.__devices[mac] = device
+        logger.debug(f"Reader {mac}: {device}")
+        if self.on_change is not None:
+            try:
+                await self.on_change(mac, device)
+            except Exception as e:
+                logger.exception(f"Handling reader {mac} failed: {e!r}")
 
     async def async_close(self) -> None:
-        assert self.aiozc is not None
-        assert self.aiobrowser is not None
-        await self.aiobrowser.async_cancel()
-        await self.aiozc.async_close()
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        browser, self.aiobrowser = self.aiobrowser, None
+        aiozc, self.aiozc = self.aiozc, None
+        try:
+            if browser is not None:
+                await browser.async_cancel()
+        finally:
+            if aiozc is not None:
+                await aiozc.async_close()
 
     def get_devices(self) -> dict[MAC, DeviceInfo]:
         """Get the devices found. Returns a dict you can modify.
@@ -80,10 +130,10 @@ class KeonnFinder:
 
 
 async def main(kf: KeonnFinder) -> None:
+    await kf.start()
     while True:
-        await kf.run_detection()
-        print(f"{time.ctime()} | Devices: {kf.get_devices()}")
         await asyncio.sleep(5)
+        print(f"{time.ctime()} | Devices: {kf.get_devices()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,339 @@
+import asyncio
+import json
+from collections import deque
+from collections.abc import Iterable
+from typing import Literal, get_args
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, ValidationError
+
+from server.core import (
+    WS_CLIENT_QUEUE_SIZE,
+    WS_REPLAY_BUFFER,
+    WS_REPLAY_LIMIT,
+    WS_SLOW_CLIENT_POLICY,
+)
+from server.core.journal import journal
+from server.core.state import loc_mac
+from server.logging import get_configured_logger
+from server.models import Device, Event, EventType, TagEvent
+
+logger = get_configured_logger(__name__, "DEBUG")
+
+SlowClientPolicy = Literal["drop", "disconnect"]
+
+# https://www.rfc-editor.org/rfc/rfc6455#section-7.4.1 "Try Again Later"
+CLOSE_TOO_SLOW = 1013
+REPLAY_CHUNK = 500
+
+
+def encode_event(e: TagEvent) -> str:
+    return json.dumps(
+        {
+            "id": e.id,
+            "type": int(e.type),
+            "tag_id": e.tag_id,
+            "epc": e.epc,
+            "data": e.data,
+            "created_at": e.created_at.isoformat(),
+        },
+        separators=(",", ":"),
+    )
+
+
+class Subscription(BaseModel):
+    """Sent by a /ws/mqtt client to choose its events, replacing the previous one.
+
+    An event has to be at one of `devices`/`locations` (if any are given), of one
+    of `types` and for a tag whose EPC starts with one of `epc_prefixes`.
+    With `since`, the matching events with a greater id are replayed first.
+    """
+
+    devices: list[int] = []
+    locations: list[str] = []
+    types: list[EventType] = []
+    epc_prefixes: list[str] = []
+    since: int | None = None
+
+
+def event_places(e: TagEvent) -> tuple[set[str], set[str]]:
+    """Locations and reader MACs an event is about."""
+    locs = {e.loc}
+    if isinstance(e.data, dict):
+        locs.update((e.data.get("from"), e.data.get("to")))
+    locs.discard(None)
+    macs = {loc_mac(loc) for loc in locs}
+    if e.tag_id is None and isinstance(e.data, dict) and "device" in e.data:
+        macs.add(e.data["device"])
+    return locs, macs
+
+
+class Subscriber:
+    def __init__(self, ws: WebSocket, maxsize: int) -> None:
+        self.ws = ws
+        self.frames: deque[tuple[int | None, str]] = deque()  # (event id, frame)
+        self.send_lock = asyncio.Lock()
+        self.paused = False  # while a replay is being sent
+        self.replayed_upto = 0
+        self.maxsize = maxsize
+        self.wakeup = asyncio.Event()
+        self.too_slow = False
+        self.dropped = 0
+        self.macs: set[str] = set()
+        self.locs: set[str] = set()
+        self.types: set[EventType] = set()
+        self.epc_prefixes: tuple[str, ...] = ()
+
+    def wants(self, e: TagEvent) -> bool:
+        """Type and EPC part of the subscription, the place is indexed by the hub."""
+        if self.types and e.type not in self.types:
+            return False
+        if self.epc_prefixes:
+            return e.epc is not None and e.epc.startswith(self.epc_prefixes)
+        return True
+
+    def matches(self, e: TagEvent) -> bool:
+        if self.macs or self.locs:
+            locs, macs = event_places(e)
+            if not (self.locs & locs or self.macs & macs):
+                return False
+        return self.wants(e)
+
+    async def send(self, frames: list[str]) -> None:
+        async with self.send_lock:
+            await self.ws.send_text("[" + ",".join(frames) + "]")
+
+
+class EventHub:
+    """Fans events out to websocket subscribers.
+
+    Subscribers are indexed by the locations and reader MACs they asked for,
+    so an event is only checked against the subscribers of its places (plus
+    the ones without a place filter) and encoded once, if anyone wants it.
+    Each subscriber has its own bounded frame queue drained by its own writer
+    task, which sends everything that piled up since the last send as one JSON
+    array. A subscriber whose queue is full either loses its oldest frames
+    (`drop`) or gets disconnected (`disconnect`).
+
+    The last `replay_size` events are kept to replay the gap to reconnecting
+    clients, older gaps (up to `replay_limit` events) are read from the journal
+    and the DB.
+    """
+
+    def __init__(
+        self,
+        queue_size: int,
+        policy: SlowClientPolicy = "drop",
+        replay_size: int = 10_000,
+        replay_limit: int = 50_000,
+    ) -> None:
+        if policy not in get_args(SlowClientPolicy):
+            raise ValueError(
+                f"Unknown slow client policy {policy!r}, "
+                f"expected one of {get_args(SlowClientPolicy)}"
+            )
+        self.__recent: deque[TagEvent] = deque(maxlen=replay_size)
+        self.replay_limit = replay_limit
+        self.__subs: set[Subscriber] = set()
+        self.__anywhere: set[Subscriber] = set()
+        self.__by_loc: dict[str, set[Subscriber]] = {}
+        self.__by_mac: dict[str, set[Subscriber]] = {}
+        self.queue_size = queue_size
+        self.policy = policy
+
+    @staticmethod
+    def _index(index: dict[str, set[Subscriber]], keys: Iterable[str], sub) -> None:
+        for key in keys:
+            index.setdefault(key, set()).add(sub)
+
+    @staticmethod
+    def _unindex(index: dict[str, set[Subscriber]], keys: Iterable[str], sub) -> None:
+        for key in keys:
+            subs = index.get(key)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del index[key]
+
+    def _add(self, sub: Subscriber) -> None:
+        self.__subs.add(sub)
+        if not sub.macs and not sub.locs:
+            self.__anywhere.add(sub)
+        self._index(self.__by_loc, sub.locs, sub)
+        self._index(self.__by_mac, sub.macs, sub)
+
+    def _remove(self, sub: Subscriber) -> None:
+        self.__subs.discard(sub)
+        self.__anywhere.discard(sub)
+        self._unindex(self.__by_loc, sub.locs, sub)
+        self._unindex(self.__by_mac, sub.macs, sub)
+
+    async def subscribe(self, sub: Subscriber, subscription: Subscription) -> None:
+        macs = set()
+        if subscription.devices:
+            macs = set(
+                await Device.filter(id__in=subscription.devices).values_list(
+                    "mac", flat=True
+                )
+            )
+            if not macs:
+                raise ValueError(f"No devices {subscription.devices}")
+        self._remove(sub)
+        sub.macs = macs
+        sub.locs = set(subscription.locations)
+        sub.types = set(subscription.types)
+        sub.epc_prefixes = tuple(subscription.epc_prefixes)
+        self._add(sub)
+        if subscription.since is not None:
+            await self.replay(sub, subscription.since)
+
+    async def replay(self, sub: Subscriber, since: int) -> None:
+        """Send the matching events after `since` ahead of the live ones."""
+        sub.paused = True
+        try:
+            # everything published from now on is in sub.frames
+            recent = [e for e in self.__recent if e.id is not None and e.id > since]
+            upper = self.__recent[0].id if self.__recent else None
+            missed: list[TagEvent] = []
+            if upper is None or since + 1 < upper:
+                # the journal first, a segment only leaves it after its commit
+                spilled = await journal.between(since, upper)
+                q = Event.filter(id__gt=since)
+                if upper is not None:
+                    q = q.filter(id__lt=upper)
+                rows = (
+                    await q.order_by("id")
+                    .limit(self.replay_limit + 1)
+                    .values(
+                        "id", "type", "tag_id", "data", "created_at", "loc", "tag__epc"
+                    )
+                )
+                stored = {r["id"] for r in rows}
+                spilled = [e for e in spilled if e.id not in stored]
+                if len(rows) + len(spilled) > self.replay_limit:
+                    logger.warning(f"Gap since {since} too big to replay")
+                    async with sub.send_lock:
+                        await sub.ws.send_text(
+                            json.dumps(
+                                {"error": "Gap too big to replay", "resync": True}
+                            )
+                        )
+                    return
+                missed = [
+                    TagEvent(
+                        type=EventType(r["type"]),
+                        tag_id=r["tag_id"],
+                        data=r["data"],
+                        created_at=r["created_at"],
+                        epc=r["tag__epc"],
+                        loc=r["loc"],
+                        id=r["id"],
+                    )
+                    for r in rows
+                ]
+                missed = sorted(missed + spilled, key=lambda e: e.id)
+            gap = missed + recent
+            frames = [encode_event(e) for e in gap if sub.matches(e)]
+            for i in range(0, len(frames), REPLAY_CHUNK):
+                await sub.send(frames[i : i + REPLAY_CHUNK])
+            if gap:
+                sub.replayed_upto = max(e.id for e in gap)
+            logger.debug(f"Replayed {len(frames)} events since {since}")
+        finally:
+            sub.paused = False
+            sub.wakeup.set()
+
+    def _targets(self, e: TagEvent) -> set[Subscriber]:
+        locs, macs = event_places(e)
+        targets = set(self.__anywhere)
+        for loc in locs:
+            targets |= self.__by_loc.get(loc, set())
+        for mac in macs:
+            targets |= self.__by_mac.get(mac, set())
+        return {sub for sub in targets if sub.wants(e)}
+
+    def publish(self, events: list[TagEvent]) -> None:
+        self.__recent.extend(events)
+        if not self.__subs:
+            return
+        for e in events:
+            targets = self._targets(e)
+            if not targets:
+                continue
+            frame = (e.id, encode_event(e))
+            for sub in targets:
+                self._offer(sub, (frame,))
+
+    def _offer(self, sub: Subscriber, frames: Iterable[tuple[int | None, str]]) -> None:
+        if sub.too_slow:
+            return
+        sub.frames.extend(frames)
+        overflow = len(sub.frames) - sub.maxsize
+        if overflow > 0:
+            if self.policy == "disconnect":
+                sub.too_slow = True
+                sub.frames.clear()
+            else:
+                for _ in range(overflow):
+                    sub.frames.popleft()
+                sub.dropped += overflow
+        sub.wakeup.set()
+
+    async def _writer(self, sub: Subscriber) -> None:
+        while True:
+            await sub.wakeup.wait()
+            sub.wakeup.clear()
+            if sub.too_slow:
+                logger.warning(f"Disconnecting slow websocket {sub.ws.client}")
+                await sub.ws.close(CLOSE_TOO_SLOW, "Too slow")
+                return
+            if sub.paused or not sub.frames:
+                continue
+            # skip what a replay already sent
+            frames = [f for id, f in sub.frames if id is None or id > sub.replayed_upto]
+            sub.frames.clear()
+            if frames:
+                await sub.send(frames)
+
+    async def _reader(self, sub: Subscriber) -> None:
+        while True:
+            text = await sub.ws.receive_text()
+            try:
+                await self.subscribe(sub, Subscription.model_validate_json(text))
+            except (ValidationError, ValueError) as e:
+                async with sub.send_lock:
+                    await sub.ws.send_text(json.dumps({"error": str(e)}))
+
+    async def serve(self, ws: WebSocket, since: int | None = None) -> None:
+        """Stream events to an accepted websocket until either side hangs up."""
+        sub = Subscriber(ws, self.queue_size)
+        tasks: list[asyncio.Task] = []
+        try:
+            self._add(sub)
+            if since is not None:
+                await self.replay(sub, since)
+            tasks = [
+                asyncio.create_task(self._writer(sub)),
+                asyncio.create_task(self._reader(sub)),
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._remove(sub)
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception) and not isinstance(
+                    result, (WebSocketDisconnect, RuntimeError)
+                ):
+                    logger.error(f"Websocket {ws.client} failed: {result!r}")
+            if sub.dropped:
+                logger.warning(f"Dropped {sub.dropped} frames for {ws.client}")
+
+    def __len__(self) -> int:
+        return len(self.__subs)
+
+
+hub = EventHub(
+    WS_CLIENT_QUEUE_SIZE, WS_SLOW_CLIENT_POLICY, WS_REPLAY_BUFFER, WS_REPLAY_LIMIT
+)
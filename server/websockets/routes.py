@@ -1,7 +1,6 @@
 from fastapi import APIRouter, WebSocket
-from server.models import MQTT_Message
+from server.websockets.hub import hub
 from uuid import uuid4
-import asyncio
 from starlette.responses import FileResponse
 import pathlib as pl
 
@@ -46,22 +45,8 @@ async def ws_chat(websocket: WebSocket):
         del connections[id]
 
 
-mqtt_websockets: list[WebSocket] = []
-
-
-async def notify_sessions(message: MQTT_Message):
-    for ws in mqtt_websockets:
-        await ws.send_json(message.model_dump())
-
-
 @router.websocket("/mqtt")
-async def ws_mqtt(websocket: WebSocket):
+async def ws_mqtt(websocket: WebSocket, since: int | None = None):
+    """Live tag events, published only by a backend that ingests them itself."""
     await websocket.accept()
-    mqtt_websockets.append(websocket)
-    try:
-        while True:
-            await websocket.receive()
-    except Exception:
-        pass
-    finally:
-        mqtt_websockets.remove(websocket)
+    await hub.serve(websocket, since)